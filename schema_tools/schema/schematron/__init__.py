@@ -6,22 +6,29 @@ Schematron rules are using XSLT Patterns, which require some XSLT engine, which
 So: this Schematron validation IS NOT perfect, yet good enough to handle a lot and while YMMV, I try to apply more and more fixes, making it more robust ;-)
 """
 
-from typing import List, Union
-
 from pathlib import Path
 
-import json
-
-import elementpath
-
-from elementpath.xpath3 import XPath3Parser
-
-# this injects custom functions in the parser
-import schema_tools.schema.schematron.functions # noqa: F401
+from importlib.resources import as_file, files
 
+from schema_tools import resources
 from schema_tools import xml
 
+from schema_tools.schema.schematron.xpath import ( # noqa: F401
+  Expression, XPathDocument, select, select_find, select_query
+)
+from schema_tools.schema.schematron.compiler import ( # noqa: F401
+  CompiledSchematron, Scope, compile_schematron
+)
+from schema_tools.schema.schematron.profiler import Profiler
+from schema_tools.schema.schematron.budget   import ( # noqa: F401
+  Budget, budget as make_budget
+)
+from schema_tools.schema.schematron.reporting import Failure, Report # noqa: F401
+from schema_tools.schema.schematron.session   import Session # noqa: F401
+from schema_tools.schema.schematron import transpiler
+
 from rich.console import Console
+from rich.table   import Table
 
 import logging
 
@@ -29,64 +36,6 @@ logger = logging.getLogger(__name__)
 
 console = Console()
 
-def select(
-  root, query,
-  namespaces={"":"http://purl.oclc.org/dsdl/schematron"},
-  context=None,
-  variables=None,
-  return_list=True,
-  return_node=False,
-  debug=False
-) -> Union[bool,List,str]:
-  """
-  utility function wrapping `elementpath.select` with some sensible defaults and error handling
-  """
-  try:
-    logger.debug(f"root={root}")
-    logger.debug(f"query={query}")
-    logger.debug(f"context={context}")
-    result = elementpath.select(
-      root, query, namespaces=namespaces, item=context, variables=variables,
-      parser=XPath3Parser
-    )
-    logger.debug(f"result={result}")
-    # return first value in list
-    if not return_list and isinstance(result, list):
-      logger.debug("UNWRAPPING LIST")
-      result = result[0] if len(result) else None
-
-    # try opportunistic unwrapping of text node
-    if not return_node:
-      try:
-        return result.text
-      except AttributeError:
-        pass
-    return result
-
-  except elementpath.exceptions.ElementPathValueError as ex:
-    logger.error(ex)
-    return False
-  except (
-    elementpath.exceptions.ElementPathNameError, elementpath.exceptions.ElementPathTypeError
-  ) as ex:
-    logger.warning(f"for query '{query}':")
-    logger.warning(f"can't perform select: {ex}")
-    logger.warning(json.dumps(variables, indent=2, default=str))
-    return [] if return_list else True
-
-def select_find(*args, **kwargs) -> List:
-  """
-  wrapper utility function for `select`, ensuring that a list if returned
-  """
-  result = select(*args, **kwargs)
-  return result if isinstance(result,list) else []
-
-def select_query(*args, **kwargs) -> Union[bool,List,str]:
-  """
-  wrapper utility function for `select`, ensuring that a value is returned, not a list.
-  """
-  return select(*args, **kwargs, return_list=False)
-
 def schema_namespaces(root):
   """
   detects namespaces in "ns" tags from a Schematron ElementTree
@@ -98,7 +47,7 @@ def schema_namespaces(root):
 
 def schema_variables(xml_root, context_root, namespaces=None):
   """
-  discover variables in context and evaluate those variables within the scope of the xml
+  discover variables in context and evaluate those variables within the scope of the xml, which can be a prepared `XPathDocument` to avoid rebuilding its node tree for every variable
   """
   variables = {}
   for let in select_find(context_root, "let"):
@@ -111,83 +60,36 @@ def schema_variables(xml_root, context_root, namespaces=None):
     logger.debug(f"discovered variable {name}={value}")
   return variables
 
-def validate_schematron(xml_root, schematron_filename) -> int:
+def validate_schematron(
+  xml_root, schematron_filename, budget=None, report=None, jobs=None,
+  phase=None
+) -> int:
   """
-  validates an ElementTree against a Schematron
+  validates an ElementTree against a Schematron, which is compiled once and reused, optionally within a `Budget`, collecting failures in a `Report` and across a pool of jobs processes, and only for the patterns of a phase
   """
-  schematron_root = xml.load(schematron_filename)
-  namespaces      = schema_namespaces(schematron_root)
-  variables       = schema_variables(xml_root, schematron_root, namespaces)
+  schematron = compile_schematron(schematron_filename, phase)
 
   logger.info(
     f"validating against schematron '{schematron_filename.name}'",
     extra={"markup": True}
   )
-  logger.debug("with variables:")
-  logger.debug(json.dumps(variables, indent=2, default=str))
+  return schematron.validate(xml_root, budget=budget, report=report, jobs=jobs)
 
-  errors   = 0
-  warnings = 0
-  # for every pattern in the schematron
-  for pattern in select_find(schematron_root, "pattern"):
-    pattern_variables = schema_variables(xml_root, pattern, namespaces)
-    logger.debug("pattern variables:")
-    logger.debug(json.dumps(pattern_variables, indent=2, default=str))
-
-    # for every rule in the schematron/pattern
-    for rule in select_find(pattern, "rule"):
-      rule_variables = schema_variables(xml_root, rule, namespaces)
-      logger.debug("rule variables:")
-      logger.debug(json.dumps(rule_variables, indent=2, default=str))
-      context_query = rule.get("context")
-
-      # for every context in the schematron/pattern/rule
-      contexts = select_find(
-        xml_root, context_query, namespaces=namespaces,
-        variables=variables | pattern_variables | rule_variables
-      )
-      for context in contexts:
-        # perform every assertion in the schematron/pattern/rule given context
-        for assertion in select_find(rule, "assert"):
-          assertion_query = assertion.get("test")
-          fatal           = assertion.get("flag") == "fatal"
-          logger.debug(assertion_query)
-          logger.debug(json.dumps(
-            variables | pattern_variables | rule_variables,
-            indent=2, default=str
-          ))
-          result = select_query(
-            xml_root, assertion_query,
-            namespaces=namespaces,
-            context=context,
-            variables=variables | pattern_variables | rule_variables
-          )
-          if not result:
-            if fatal:
-              errors += 1
-              logger_func = logger.error
-              color = "red"
-            else:
-              warnings += 1
-              logger_func = logger.warning
-              color = "yellow"
-            logger_func(f"""[{color}]{assertion.text}[/{color}]
-  [blue]context[/blue]: {context_query}
-  [blue]query[/blue]  : {assertion_query}""",
-                extra={"markup": True}
-              )
-  if errors:
-    logger.debug(f"schematron errors={errors}")
-  if warnings:
-    logger.debug(f"schematron warnings={warnings}")
-  return errors
-
-def validate(xml_root, schematrons):
+def validate(
+  xml_root, schematrons, mode="full", max_errors=None, deadline_ms=None,
+  budget=None, report=None, jobs=None, phase=None
+):
   """
   validates a given XML file against a given XSD and Schematron, or if omitted, the UBL 2.1 XSD and Peppol Schematron.
+  In "fail_fast" mode, validation stops at the first error, max_errors caps the number of errors and deadline_ms limits the time spent. If validation stopped before finding an error, the result is None. Alternatively an existing `Budget` can be shared.
+  Failed assertions are logged, or if a `Report` is given, collected without logging them.
+  Large documents can be validated across a pool of jobs processes.
+  A phase selects the patterns to validate: a phase id of the Schematron, or pattern ids and/or globs of assertion ids, see `phases`.
   example:
     % schema-tools validate invoice.xml
   """
+  if budget is None:
+    budget = make_budget(mode, max_errors, deadline_ms)
   # check all provided files _are_ files
   for filename in schematrons:
     if filename and not Path(filename).is_file():
@@ -196,15 +98,43 @@ def validate(xml_root, schematrons):
 
   errors = 0
   for schematron_filename in schematrons:
-    errors += validate_schematron(xml_root, schematron_filename)
+    if budget is not None and budget.check():
+      break
+    errors += validate_schematron(
+      xml_root, schematron_filename, budget, report, jobs, phase
+    )
 
-  if not errors:
-    logger.info(
-      "[bold green]✅ XML is valid[/bold green]",
-      extra={"markup": True}
+  incomplete = budget is not None and budget.exhausted
+  if incomplete and report is not None:
+    report.complete = False
+  if errors:
+    return False
+  if incomplete:
+    logger.warning(f"validation incomplete, {budget.exhausted} exhausted")
+    return None
+  logger.info(
+    "[bold green]✅ XML is valid[/bold green]",
+    extra={"markup": True}
+  )
+  return True
+
+def report(
+  xml_root, schematrons, mode="full", max_errors=None, deadline_ms=None,
+  budget=None, jobs=None, phase=None
+) -> Report:
+  """
+  validates an ElementTree against Schematrons, returning a `Report` of all failed assertions
+  """
+  result = Report()
+  for schematron_filename in schematrons:
+    result.namespaces.update(
+      compile_schematron(schematron_filename, phase).namespaces
     )
-    return True
-  return False
+  validate(
+    xml_root, schematrons, mode, max_errors, deadline_ms, budget, report=result,
+    jobs=jobs, phase=phase
+  )
+  return result
 
 def query(query, xml_filename, context=None):
   """
@@ -213,15 +143,65 @@ def query(query, xml_filename, context=None):
     % schema-tools schematron query "@schemeID" tests/examples/invoice.xml  "cac:AccountingSupplierParty/cac:Party/cbc:EndpointID"
     0088
   """
-  xml_root   = xml.load(xml_filename)
-  logger.debug(xml_root)
-  namespaces = xml.namespaces(xml_filename)
+  xml_root, namespaces, _ = xml.load_document(xml_filename)
   logger.debug(namespaces)
+  xml_root   = XPathDocument(xml_root, namespaces)
+  logger.debug(xml_root)
   if context:
     context = select_query(xml_root, context, namespaces=namespaces, return_node=True)
     logger.debug(f"CONTEXT={context}")
   return select_find(xml_root, query, namespaces=namespaces, context=context)
 
+def profile(
+  xml_filename, *schematrons, top=20, kind=None, output=None, runs=1,
+  phase=None
+):
+  """
+  profiles validating an XML file against Schematrons, or if omitted, the CEN and Peppol Schematrons, printing the top slowest patterns, rule contexts, let variables and assertions, and optionally exporting all timings to a JSON file
+  example:
+    % schema-tools schematron profile invoice.xml --top 10 --output profile.json
+    % schema-tools schematron profile invoice.xml --phase "PEPPOL-EN16931-R0*"
+  """
+  xml_root = xml.load(xml_filename)
+  profiler = Profiler()
+  with as_file(files(resources)) as resource_root:
+    schematrons = schematrons or [
+      resource_root / "CEN-EN16931-UBL.sch",
+      resource_root / "PEPPOL-EN16931-UBL.sch"
+    ]
+    for schematron_filename in schematrons:
+      compiled = compile_schematron(schematron_filename, phase)
+      document = XPathDocument(xml_root, compiled.namespaces)
+      for _ in range(runs):
+        compiled.evaluate(document, profiler=profiler)
+
+  table = Table()
+  for column in [ "kind", "name", "calls", "total (ms)", "mean (ms)" ]:
+    table.add_column(column, justify="right" if "(" in column else "left")
+  for record in profiler.top(top, kind):
+    table.add_row(
+      record["kind"], record["name"], str(record["calls"]),
+      f"{record['total_ms']:.3f}", f"{record['mean_ms']:.3f}"
+    )
+  console.print(table)
+  if output:
+    profiler.save(output)
+    logger.info(f"wrote profile to '{output}'")
+
+def transpile(schematron_filename, output=None):
+  """
+  compiles a Schematron ahead-of-time into a Python module, which can be loaded
+  with `transpiler.load`, writing it to a file, or else returning it
+  example:
+    % schema-tools schematron compile CEN-EN16931-UBL.sch -o rules_cen.py
+  """
+  source = transpiler.generate(schematron_filename)
+  if not output:
+    return source
+  Path(output).write_text(source)
+  logger.info(f"wrote compiled Schematron to '{output}'")
+  return str(output)
+
 def _gen(name, retval, args):
   """
   utility function to generate stubs for functions
@@ -256,8 +236,7 @@ def generate_functions(schematron_filename):
   """
   generate function stubs for function definitions found in Schematron
   """
-  schematron_root = xml.load(schematron_filename)
-  namespaces      = xml.namespaces(schematron_filename)
+  schematron_root, namespaces, _ = xml.load_document(schematron_filename)
 
   for function in select_find(
     schematron_root, "function", namespaces=namespaces
@@ -272,5 +251,7 @@ def generate_functions(schematron_filename):
 # expose cli-enabled functions
 cli = {
   "query"              : query,
+  "profile"            : profile,
+  "compile"            : transpile,
   "generate_functions" : generate_functions
 }
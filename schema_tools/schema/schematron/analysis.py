@@ -0,0 +1,162 @@
+"""
+Static analysis of compiled XPath expressions.
+
+An expression is context free if its value doesn't depend on the context item it is evaluated with, e.g. when it only uses absolute paths, literals and variables. Such expressions give the same result for every context node of a rule, given the same variables.
+
+The analysis is conservative: anything that isn't known to be context free, e.g. a relative path, `.`, or a function using the context item when called without arguments, is considered to depend on the context.
+"""
+
+# functions without arguments that don't use the context item
+CONTEXT_FREE_FUNCTIONS = {
+  "true", "false", "current-date", "current-dateTime", "current-time",
+  "implicit-timezone", "default-collation", "static-base-uri"
+}
+
+# expressions with a type as second operand
+TYPE_EXPRESSIONS = { "castable", "cast", "instance", "treat" }
+
+def context_free(token):
+  """
+  checks if a token tree can be evaluated without a context item
+  """
+  if token.symbol in ("/", "//"):
+    if len(token) == 1:
+      return True                  # absolute path, relative to the root
+    return context_free(token[0])  # the right hand side is relative to the left
+  if token.symbol == "[":
+    return context_free(token[0])  # predicates are relative to the selection
+  if token.symbol in TYPE_EXPRESSIONS:
+    return context_free(token[0])
+  if token.symbol in ("$", "(string)", "(integer)", "(decimal)", "(float)"):
+    return True
+  if token.symbol == ":" and _is_function(token[1]):
+    return context_free(token[1])  # prefixed function, e.g. xs:decimal(...)
+  if _is_function(token):
+    if len(token) == 0:
+      return token.symbol in CONTEXT_FREE_FUNCTIONS
+    return all(context_free(argument) for argument in token)
+  if token.label in ("operator", "expression"):
+    return all(context_free(operand) for operand in token)
+  # names, wildcards, axes, kind tests, `.`, `..`, `@`,...
+  return False
+
+def _is_function(token):
+  return token.label == "function" or token.label == "constructor function"
+
+# expressions binding variables: $name in/:= expression pairs, and a body
+BINDING_EXPRESSIONS = { "some", "every", "for", "let" }
+
+def bound_variables(token):
+  """
+  returns the names of the variables bound by a quantified, for or let
+  expression, or an empty set for other tokens
+  """
+  if token.symbol not in BINDING_EXPRESSIONS or token.label != "expression":
+    return set()
+  return { token[index].value for index in range(0, len(token) - 1, 2) }
+
+def variable_references(token):
+  """
+  returns the names of all variables referenced in a token tree, that aren't
+  bound within it
+  """
+  if token.symbol == "$":
+    return { token.value }
+  names = set()
+  for child in token:
+    names |= variable_references(child)
+  return names - bound_variables(token)
+
+# functions that depend on the position of the context item
+POSITIONAL_FUNCTIONS = { "position", "last" }
+
+def positional(token):
+  """
+  checks if a token tree calls a function depending on the position of the
+  context item
+  """
+  if _is_function(token) and token.symbol in POSITIONAL_FUNCTIONS:
+    return True
+  return any(positional(child) for child in token)
+
+def subexpressions(token):
+  """
+  returns the subexpressions of a token tree that select or compute a value
+  given only the context item, i.e. paths and function calls without variables
+  or positional functions, but no steps of paths, which depend on the axis of
+  their path
+  """
+  found = []
+  _subexpressions(token, False, found)
+  return found
+
+def _subexpressions(token, step, found):
+  # returns True if the token depends on more than the context item
+  dependent = token.symbol == "$" or \
+              (_is_function(token) and token.symbol in POSITIONAL_FUNCTIONS)
+  for index, child in enumerate(token):
+    is_step = token.symbol in ("/", "//") and index == len(token) - 1
+    dependent = _subexpressions(child, is_step, found) or dependent
+  if not step and not dependent and (
+    _computes(token) or (token.symbol == ":" and _computes(token[1]))
+  ):
+    found.append(token)
+  return dependent
+
+def _computes(token):
+  # paths, predicates and function calls with arguments
+  return token.symbol in ("/", "//", "[") or (_is_function(token) and len(token))
+
+def shared_subexpressions(tokens):
+  """
+  returns the subexpressions that occur more than once in a collection of token
+  trees, grouped by their source
+  """
+  occurrences = {}
+  for token in tokens:
+    for subexpression in subexpressions(token):
+      occurrences.setdefault(subexpression.source, []).append(subexpression)
+  return {
+    source : shared for source, shared in occurrences.items() if len(shared) > 1
+  }
+
+def document_subexpressions(token):
+  """
+  returns the largest subexpressions of a token tree that only depend on the
+  document, i.e. context free paths and function calls without variables
+  """
+  if _computes(token) and context_free(token) and \
+     not variable_references(token):
+    return [ token ]
+  found = []
+  for child in token:
+    found.extend(document_subexpressions(child))
+  return found
+
+# axes and functions that look outside of the subtree of the context item
+LOCAL_AXES         = { "child", "descendant", "descendant-or-self", "self", "attribute" }
+NONLOCAL_FUNCTIONS = {
+  "position", "last", "root", "id", "idref", "element-with-id", "lang", "doc",
+  "doc-available", "collection", "uri-collection", "document-uri"
+}
+
+def local(token, variables=()):
+  """
+  checks if a token tree only depends on the subtree of the context item, and
+  the given variables, i.e. it only uses relative paths that don't leave the
+  subtree
+  """
+  if token.symbol == "$":
+    return token.value in variables
+  bound = bound_variables(token)
+  if bound:
+    variables = set(variables) | bound
+  if token.symbol in ("/", "//") and len(token) == 1:
+    return False                 # absolute path
+  if token.symbol == "..":
+    return False
+  if token.label == "axis" and token.symbol not in LOCAL_AXES:
+    return False
+  if _is_function(token) and token.symbol in NONLOCAL_FUNCTIONS:
+    return False
+  return all(local(child, variables) for child in token)
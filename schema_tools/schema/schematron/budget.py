@@ -0,0 +1,59 @@
+"""
+Budgeted validation.
+
+A `Budget` can be passed to `CompiledSchematron.evaluate` to stop validating once a maximum number of errors has been found, or a deadline has passed. A budget can be shared by several validations, e.g. the XSD and both Schematrons of a UBL document, so that errors and time add up. When a budget is exhausted, the result is partial: errors that have been found are real, but a document without errors isn't known to be valid.
+
+modes:
+  full      : validate everything, unless a maximum or deadline is given
+  fail_fast : stop at the first error
+"""
+
+import time
+
+MODES = [ "full", "fail_fast" ]
+
+class Budget:
+  """
+  limits a validation to a maximum number of errors and/or a deadline in
+  milliseconds from now, recording the reason when it is exhausted
+  """
+  def __init__(self, max_errors=None, deadline_ms=None):
+    self.max_errors = max_errors
+    self.deadline   = None
+    if deadline_ms is not None:
+      self.deadline = time.perf_counter() + deadline_ms / 1000
+    self.errors     = 0
+    self.exhausted  = None # "max_errors" or "deadline"
+
+  def __repr__(self):
+    return f"Budget(errors={self.errors}, exhausted={self.exhausted})"
+
+  def spend(self, errors):
+    """
+    records errors, returning True if the budget is exhausted
+    """
+    self.errors += errors
+    return self.check()
+
+  def check(self):
+    """
+    returns True if the budget is exhausted
+    """
+    if self.exhausted is None:
+      if self.max_errors is not None and self.errors >= self.max_errors:
+        self.exhausted = "max_errors"
+      elif self.deadline is not None and time.perf_counter() >= self.deadline:
+        self.exhausted = "deadline"
+    return self.exhausted is not None
+
+def budget(mode="full", max_errors=None, deadline_ms=None):
+  """
+  returns a `Budget` for a validation mode, or None if nothing is limited
+  """
+  if mode not in MODES:
+    raise ValueError(f"unknown validation mode '{mode}', expected one of {MODES}")
+  if mode == "fail_fast":
+    max_errors = 1
+  if max_errors is None and deadline_ms is None:
+    return None
+  return Budget(max_errors, deadline_ms)
@@ -0,0 +1,750 @@
+"""
+Compiled Schematron rule sets.
+
+Parsing a Schematron file and its XPath queries is done once, resulting in a `CompiledSchematron` that can validate many XML documents, without tokenizing and parsing the same queries over and over again.
+
+A Schematron file is first read into a definition, a plain structure of dicts and lists holding its namespaces, variables, patterns, rules and assertions, which is then compiled. Such a definition can also be generated as Python code, see `transpiler`.
+"""
+
+import logging
+import multiprocessing
+import re
+import time
+from pathlib import Path
+
+import elementpath
+from elementpath import ElementNode, XPathNode
+
+from schema_tools import xml
+from schema_tools.schema.schematron import phases
+from schema_tools.schema.schematron.analysis import (
+  context_free,
+  document_subexpressions,
+  local,
+  shared_subexpressions,
+  variable_references,
+)
+from schema_tools.schema.schematron.matching import Unmatchable, compile_matcher
+from schema_tools.schema.schematron.reporting import (
+  Failure,
+  Report,
+  location,
+  log_failure,
+)
+from schema_tools.schema.schematron.xpath import (
+  Expression,
+  XPathDocument,
+  select,
+  select_find,
+  select_query,
+  share,
+  shared_parser,
+)
+
+logger = logging.getLogger(__name__)
+
+def read_schematron(schematron_filename):
+  """
+  reads a Schematron file into a definition
+  """
+  schematron_root = xml.load(schematron_filename)
+  def variables(element):
+    return [
+      (let.get("name"), let.get("value")) for let in select_find(element, "let")
+    ]
+  return {
+    "namespaces" : {
+      element.get("prefix") : element.get("uri")
+      for element in select_find(schematron_root, "ns")
+    },
+    "variables"  : variables(schematron_root),
+    "phases"     : {
+      phase.get("id") : [
+        active.get("pattern") for active in select_find(phase, "active")
+      ]
+      for phase in select_find(schematron_root, "phase")
+    },
+    "default_phase" : schematron_root.get("defaultPhase"),
+    "patterns"   : [
+      {
+        "id"        : pattern.get("id"),
+        "variables" : variables(pattern),
+        "rules"     : [
+          {
+            "context"    : rule.get("context"),
+            "variables"  : variables(rule),
+            "assertions" : [
+              {
+                "id"   : assertion.get("id"),
+                "flag" : assertion.get("flag"),
+                "text" : assertion.text,
+                "test" : assertion.get("test")
+              }
+              for assertion in select_find(rule, "assert")
+            ]
+          }
+          for rule in select_find(pattern, "rule")
+        ]
+      }
+      for pattern in select_find(schematron_root, "pattern")
+    ]
+  }
+
+class Assertion:
+  def __init__(self, definition, parser):
+    self.id       = definition["id"]
+    self.flag     = definition["flag"]
+    self.fatal    = self.flag == "fatal"
+    self.text     = definition["text"]
+    self.test     = Expression(definition["test"], parser=parser)
+    # an optional Python implementation of the test, given an ElementTree
+    self.function = definition.get("function")
+    self.context_free = False
+    # the document level variables of a test that only depends on the subtree
+    # of the context node, or None, see `Rule` and `session`
+    self.dependencies = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["function"] = None # generated functions aren't importable by name
+    return state
+
+class Rule:
+  def __init__(self, definition, parser):
+    self.context    = Expression(definition["context"], parser=parser)
+    self.matcher    = compile_matcher(self.context)
+    self.variables  = compile_variables(definition["variables"], parser)
+    self.assertions = [
+      Assertion(assertion, parser) for assertion in definition["assertions"]
+    ]
+    # lets that depend on the context node are evaluated for every node, others
+    # once per document
+    dependent = set()
+    for name, expression in self.variables:
+      if expression.token is None or not context_free(expression.token) or \
+         variable_references(expression.token) & dependent:
+        dependent.add(name)
+    self.context_variables = [
+      (name, expression) for name, expression in self.variables
+      if name in dependent
+    ]
+    self.static_variables  = [
+      (name, expression) for name, expression in self.variables
+      if name not in dependent
+    ]
+    # assertions that don't depend on the context node are evaluated once
+    for assertion in self.assertions:
+      token = assertion.test.token
+      assertion.context_free = token is not None and context_free(token) and \
+                               not variable_references(token) & dependent
+    # assertions that only depend on the subtree of the context node, and on
+    # document level variables
+    local_variables = {}
+    def dependencies(expression):
+      if expression.token is None:
+        return None
+      references = variable_references(expression.token)
+      if not local(expression.token, references):
+        return None
+      outside = set()
+      for name in references:
+        if name in local_variables:
+          outside |= local_variables[name]
+        elif name in dependent:
+          return None
+        else:
+          outside.add(name)
+      return outside
+    for name, expression in self.context_variables:
+      outside = dependencies(expression)
+      if outside is not None:
+        local_variables[name] = outside
+    for assertion in self.assertions:
+      outside = dependencies(assertion.test)
+      if outside is not None:
+        assertion.dependencies = tuple(sorted(outside))
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop("matcher") # holds tokens of the context, see Expression
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.matcher = compile_matcher(self.context)
+
+  @property
+  def names(self):
+    """
+    the names of the elements the context can match, or None if unknown
+    """
+    return None if self.matcher is None else self.matcher.names
+
+  def applicable(self, names):
+    """
+    checks if the context can match a document containing elements with the
+    given names
+    """
+    if self.matcher is None:
+      return True
+    return any(required <= names for required in self.matcher.requires)
+
+  def within(self, names):
+    """
+    checks if the context can only match elements with one of the given names,
+    or their descendants
+    """
+    if self.matcher is None:
+      return False
+    return all(required & names for required in self.matcher.requires)
+
+  def matches(self, node, document, variables):
+    """
+    checks if a node matches the context of the rule
+    """
+    if self.matcher is not None:
+      try:
+        return self.matcher.matches(node, document, variables)
+      except Unmatchable as ex:
+        logger.debug(f"falling back to query for '{self.context.query}': {ex}")
+    return node in self.selected(document, variables)
+
+  def selected(self, document, variables):
+    """
+    returns the nodes selected by the context as an XPath query, once per
+    document, which can also be other nodes than elements, e.g. attributes
+    """
+    if self.context not in document.selections:
+      selected = set()
+      token = self.context.token
+      if token is not None and token.symbol == "/" and len(token) == 0:
+        # queries are evaluated on the root element, which `/` doesn't select
+        selected = { document.root_node }
+      elif token is not None:
+        context = document.context(None, variables, self.context.namespaces)
+        try:
+          selected = set(token.select(context))
+        except elementpath.exceptions.ElementPathError as ex:
+          logger.warning(f"can't select context '{self.context.query}': {ex}")
+      document.selections[self.context] = selected
+    return document.selections[self.context]
+
+# the names of elements selected using a descendant axis, e.g. //cac:Price
+DESCENDANTS = re.compile(
+  r"(?://|descendant(?:-or-self)?::)\s*(?:[\w.-]+:)?([\w.-]+|\*)"
+)
+
+class Pattern:
+  def __init__(self, definition, parser):
+    self.id        = definition["id"]
+    self.variables = compile_variables(definition["variables"], parser)
+    self.rules     = [ Rule(rule, parser) for rule in definition["rules"] ]
+    self._dispatch = {}
+
+  def candidates(self, name):
+    """
+    returns the rules, in order, with a context that can match an element with
+    a given name
+    """
+    if name not in self._dispatch:
+      self._dispatch[name] = [
+        rule for rule in self.rules
+        if rule.names is None or name in rule.names
+      ]
+    return self._dispatch[name]
+
+  def names(self):
+    """
+    returns the element names all rules can match, or None if any rule can match
+    any element
+    """
+    names = set()
+    for rule in self.rules:
+      if rule.names is None:
+        return None
+      names |= rule.names
+    return names
+
+  def match(self, node, document, variables, applicable=None, profiler=None):
+    """
+    returns the first rule with a context matching a node, if any,
+    optionally only considering a set of applicable rules
+    """
+    for rule in self.candidates(node.name):
+      if applicable is not None and rule not in applicable:
+        continue
+      if profiler is None:
+        matches = rule.matches(node, document, variables)
+      else:
+        start   = time.perf_counter()
+        matches = rule.matches(node, document, variables)
+        profiler.record(
+          "context", rule.context.query, time.perf_counter() - start
+        )
+      if matches:
+        return rule
+    return None
+
+def compile_variables(variables, parser):
+  """
+  compiles the `let` variables defined in the scope of a Schematron element
+  """
+  return [
+    (name, Expression(value, parser=parser)) for name, value in variables
+  ]
+
+class Scope:
+  """
+  compiled let variables, evaluated on first reference and memoized, optionally
+  given a context node, falling back to an enclosing scope for other variables
+  """
+  def __init__(
+    self, document, variables, parent=None, context=None, profiler=None
+  ):
+    self.document  = document
+    self.variables = dict(variables)
+    self.parent    = parent
+    self.context   = context
+    self.profiler  = profiler
+    self.values    = {}
+
+  def __repr__(self):
+    return f"Scope({', '.join(self.variables)})"
+
+  def __contains__(self, name):
+    return name in self.variables or (
+      self.parent is not None and name in self.parent
+    )
+
+  def __getitem__(self, name):
+    if name in self.values:
+      return self.values[name]
+    if name not in self.variables:
+      if self.parent is None:
+        raise KeyError(name)
+      return self.parent[name]
+    start = time.perf_counter() if self.profiler is not None else None
+    value = select(
+      self.document, self.variables[name], context=self.context,
+      variables=self, return_node=True
+    )
+    if self.profiler is not None:
+      self.profiler.record("let", name, time.perf_counter() - start)
+    self.values[name] = value
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f"discovered variable {name}={value}")
+    return value
+
+class CompiledSchematron:
+  """
+  a Schematron with all its XPath queries compiled, ready to validate documents
+  """
+  def __init__(self, schematron_filename, definition=None, phase=None):
+    self.filename   = schematron_filename
+    self.phase      = phase
+    if definition is None:
+      definition = read_schematron(schematron_filename)
+    definition      = phases.select(definition, phase)
+    self.namespaces = definition["namespaces"]
+    parser          = shared_parser(self.namespaces)
+    self.variables  = compile_variables(definition["variables"], parser)
+    self.patterns   = [
+      Pattern(pattern, parser) for pattern in definition["patterns"]
+    ]
+    self.shared     = self._share_subexpressions()
+
+  def __setstate__(self, state):
+    # expressions are parsed again when unpickled, so share them again
+    self.__dict__.update(state)
+    self.shared = self._share_subexpressions()
+
+  def _share_subexpressions(self):
+    """
+    caches the values of subexpressions that occur in several assertions, per
+    document and context item, returning their sources. Subexpressions of
+    assertions and rule variables that only depend on the document, are cached
+    per document.
+    """
+    tokens = [
+      assertion.test.token
+      for pattern in self.patterns
+      for rule in pattern.rules
+      for assertion in rule.assertions
+      if assertion.test.token is not None
+    ]
+    shared = shared_subexpressions(tokens)
+    for source, subexpressions in shared.items():
+      for subexpression in subexpressions:
+        share(subexpression, source)
+    tokens += [
+      expression.token
+      for pattern in self.patterns
+      for rule in pattern.rules
+      for _, expression in rule.variables
+      if expression.token is not None
+    ]
+    for token in tokens:
+      for subexpression in document_subexpressions(token):
+        share(subexpression, context_free=True)
+    return set(shared)
+
+  def validate(self, xml_root, budget=None, report=None, jobs=None) -> int:
+    """
+    validates an ElementTree, `xml.Document` or `XPathDocument` against the
+    Schematron, returning the number of errors, optionally within a `Budget`
+    and collecting failures in a `Report`
+    """
+    errors, _ = self.evaluate(xml_root, budget=budget, report=report, jobs=jobs)
+    return errors
+
+  def spanning(self, names, descendants=()):
+    """
+    returns the assertions of rules outside of elements with the given (Clark
+    notation) names, that refer to such elements, or to descendants of them,
+    with the given names, using a descendant axis, directly or using variables
+    """
+    local     = { name.split("}")[-1] for name in names }
+    inside    = { name.split("}")[-1] for name in descendants } | { "*" }
+    def refers(expression, variables):
+      token = expression.token
+      return any(name in expression.query for name in local) or any(
+        name in inside for name in DESCENDANTS.findall(expression.query)
+      ) or (
+        token is not None and bool(variable_references(token) & variables)
+      )
+    def spanning_variables(lets, variables):
+      # lets referring to such elements directly, or through other lets
+      variables = set(variables)
+      while True:
+        found = {
+          name for name, expression in lets
+          if name not in variables and refers(expression, variables)
+        }
+        if not found:
+          return variables
+        variables |= found
+    variables = spanning_variables(self.variables, set())
+    spanning  = []
+    for pattern in self.patterns:
+      pattern_variables = spanning_variables(pattern.variables, variables)
+      for rule in pattern.rules:
+        if rule.within(names):
+          continue
+        rule_variables = spanning_variables(rule.variables, pattern_variables)
+        spanning.extend(
+          assertion for assertion in rule.assertions
+          if refers(assertion.test, rule_variables)
+        )
+    return spanning
+
+  def applicable_rules(self, document):
+    """
+    returns the rules with a context that can match an `XPathDocument`, based on
+    the names of the elements it contains
+    """
+    names = set(document.index)
+    return [
+      rule
+      for pattern in self.patterns
+      for rule in pattern.rules
+      if rule.applicable(names)
+    ]
+
+  def evaluate(
+    self, xml_root, profiler=None, budget=None, report=None, jobs=None,
+    within=None, skip=None, results=None
+  ) -> tuple[int, int]:
+    """
+    evaluates all assertions on an ElementTree, `xml.Document` or prepared
+    `XPathDocument`, returning the number of errors and warnings, optionally
+    recording timings with a `Profiler` and stopping early when a `Budget` is
+    exhausted. Failed assertions are logged, or if given, added to a `Report`.
+    With jobs, large documents are evaluated across a pool of processes, see
+    `_walk_parallel`. Evaluation can be limited to the nodes within an element,
+    and assertions to skip can be given, see `streaming`. Results of assertions
+    can be reused from a previous evaluation, see `session`.
+    """
+    debug    = logger.isEnabledFor(logging.DEBUG)
+    document = xml_root
+    if isinstance(document, xml.Document):
+      document = XPathDocument(
+        xml_root.root, self.namespaces, xml_root.node(self.namespaces)
+      )
+    elif not isinstance(document, XPathDocument):
+      document = XPathDocument(xml_root, self.namespaces)
+    variables = Scope(document, self.variables, profiler=profiler)
+
+    # skip rules, and patterns without rules, that can't fire for the document
+    applicable = set(self.applicable_rules(document))
+    patterns   = [
+      pattern for pattern in self.patterns
+      if any(rule in applicable for rule in pattern.rules)
+    ]
+    total = sum(len(pattern.rules) for pattern in self.patterns)
+    logger.debug(
+      f"skipping {total - len(applicable)} of {total} rules and "
+      f"{len(self.patterns) - len(patterns)} of {len(self.patterns)} patterns, "
+      "not applicable to the document"
+    )
+
+    scopes = [
+      Scope(document, pattern.variables, variables, profiler=profiler)
+      for pattern in patterns
+    ]
+
+    # only consider elements that can be matched by some rule, using the index
+    names = set()
+    for pattern in patterns:
+      pattern_names = pattern.names()
+      if pattern_names is None:
+        names = None
+        break
+      names |= pattern_names
+    if names is None:
+      nodes = document.elements
+    else:
+      nodes = sorted(
+        ( node for name in names for node in document.descendants(name) ),
+        key=lambda node: node.position
+      )
+
+    # contexts that aren't matched as patterns can also select other nodes,
+    # e.g. attributes or the document, which are visited in document order too
+    others = {
+      node
+      for pattern, scope in zip(patterns, scopes)
+      for rule in pattern.rules
+      if rule in applicable and rule.matcher is None
+      for node in rule.selected(document, scope)
+      if isinstance(node, XPathNode) and not isinstance(node, ElementNode)
+    }
+    if others:
+      nodes = sorted([ *nodes, *others ], key=lambda node: node.position)
+
+    if within is not None:
+      members = { id(element) for element in within.iter() }
+      def inside(node):
+        while node is not None and not isinstance(node, ElementNode):
+          node = node.parent
+        return node is not None and id(node.value) in members
+      nodes = [ node for node in nodes if inside(node) ]
+
+    labels = [
+      pattern.id or f"#{self.patterns.index(pattern)}" for pattern in patterns
+    ]
+
+    walk = (
+      document, patterns, labels, scopes, applicable, skip, results, debug
+    )
+    # the assertions that can fire on the first node, usually the root element,
+    # which document level rules fire on
+    first = [
+      assertion
+      for pattern in patterns
+      for rule in pattern.candidates(nodes[0].name) if rule in applicable
+      for assertion in rule.assertions
+    ] if nodes else []
+    shards = self._shards(nodes, jobs, len(first))
+    if len(shards) > 1 and profiler is None and budget is None and \
+       results is None:
+      errors, warnings = self._walk_parallel(
+        walk, nodes, first, shards, jobs, report
+      )
+    else:
+      errors, warnings = self._walk(walk, nodes, profiler, budget, report)
+
+    if budget is not None and budget.exhausted:
+      logger.info(f"validation stopped early, {budget.exhausted} exhausted")
+      if report is not None:
+        report.complete = False
+    if errors:
+      logger.debug(f"schematron errors={errors}")
+    if warnings:
+      logger.debug(f"schematron warnings={warnings}")
+    return errors, warnings
+
+  def _walk(self, walk, nodes, profiler, budget, report):
+    """
+    fires the rules of all patterns on a sequence of nodes, returning the number
+    of errors and warnings
+    """
+    document, patterns, labels, scopes, applicable, skip, results, debug = walk
+    rule_scopes = {}
+    hoisted     = {} # results of context free assertions
+    errors      = 0
+    warnings    = 0
+    # for every element...
+    for node in nodes:
+      if budget is not None and budget.check():
+        break
+      # ... fire the first matching rule of every pattern
+      for pattern, label, scope in zip(patterns, labels, scopes):
+        start = time.perf_counter() if profiler is not None else None
+        rule  = pattern.match(node, document, scope, applicable, profiler)
+        if rule is not None:
+          if rule not in rule_scopes:
+            rule_scopes[rule] = Scope(
+              document, rule.static_variables, scope, profiler=profiler
+            )
+          rule_scope = rule_scopes[rule]
+          if rule.context_variables:
+            rule_scope = Scope(
+              document, rule.context_variables, rule_scope, node, profiler
+            )
+          rule_errors, rule_warnings = self._assert(
+            document, node, rule, rule_scope, hoisted, profiler, budget,
+            report, skip, results, debug
+          )
+          errors   += rule_errors
+          warnings += rule_warnings
+        if profiler is not None:
+          profiler.record("pattern", label, time.perf_counter() - start)
+        if rule is not None and budget is not None and budget.spend(rule_errors):
+          break
+    return errors, warnings
+
+  def _shards(self, nodes, jobs, assertions=0):
+    """
+    splits nodes into contiguous ranges for a pool of processes, or a single
+    range if a pool isn't worth it or isn't possible. The document level rules
+    firing on the first node outweigh those on many other nodes, so the first
+    node gets a range per job, each with a part of the given number of its
+    assertions.
+    """
+    if not jobs or jobs < 2 or len(nodes) < 2 * MIN_SHARD_SIZE:
+      return [ (0, len(nodes), None) ]
+    if "fork" not in multiprocessing.get_all_start_methods():
+      return [ (0, len(nodes), None) ]
+    if multiprocessing.current_process().daemon: # e.g. a worker of iter_check
+      return [ (0, len(nodes), None) ]
+    parts = min(jobs, assertions)
+    first = [
+      (0, 1, (assertions * part // parts, assertions * (part + 1) // parts))
+      for part in range(parts)
+    ] or [ (0, 1, None) ]
+    count = min(jobs * SHARDS_PER_JOB, len(nodes) // MIN_SHARD_SIZE)
+    size  = -(-(len(nodes) - 1) // count)
+    return first + [
+      (start, min(start + size, len(nodes)), None)
+      for start in range(1, len(nodes), size)
+    ]
+
+  def _walk_parallel(self, walk, nodes, first, shards, jobs, report):
+    """
+    walks shards of nodes across a pool of forked processes, which share the
+    parsed document and compiled Schematron read-only. Shards of the first node
+    only perform a part of the assertions that can fire on it. Failures are
+    collected per shard and merged in order of the shards, so the outcome is the
+    same as walking all nodes in one process.
+    """
+    global WALK
+    WALK = ( self, walk, nodes, first )
+    try:
+      with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        results = pool.map(_walk_shard, shards, chunksize=1)
+    finally:
+      WALK = None
+    errors   = 0
+    warnings = 0
+    for shard_errors, shard_warnings, failures in results:
+      errors   += shard_errors
+      warnings += shard_warnings
+      for failure in failures:
+        if report is None:
+          log_failure(failure)
+        else:
+          report.add(failure)
+    return errors, warnings
+
+  def _assert(
+    self, document, node, rule, variables, hoisted, profiler, budget, report,
+    skip, results, debug
+  ):
+    """
+    performs every assertion of a rule given a context node, returning the
+    number of failed fatal and non-fatal assertions. Results of context free
+    assertions are kept in hoisted and reused for all context nodes. Results of
+    assertions that only depend on the subtree of the context node are looked
+    up in results, if given. Stops when a `Budget` is exhausted.
+    """
+    errors   = 0
+    warnings = 0
+    for assertion in rule.assertions:
+      if budget is not None and budget.check():
+        break
+      if skip and assertion in skip:
+        continue
+      if debug:
+        logger.debug(assertion.test.query)
+      key = None
+      if results is not None and assertion.dependencies is not None:
+        key = results.key(assertion, node, variables)
+      if assertion.context_free and assertion in hoisted:
+        result = hoisted[assertion]
+      elif key is not None and key in results:
+        result = results[key]
+      else:
+        start  = time.perf_counter() if profiler is not None else None
+        if assertion.function is not None and isinstance(node, ElementNode):
+          result = assertion.function(node.value)
+        else:
+          result = select_query(
+            document, assertion.test, context=node, variables=variables
+          )
+        if assertion.context_free:
+          hoisted[assertion] = result
+        if key is not None:
+          results[key] = bool(result) # don't keep nodes of the document
+        if profiler is not None:
+          profiler.record(
+            "assert", assertion.id or assertion.test.query,
+            time.perf_counter() - start
+          )
+      if not result:
+        if assertion.fatal:
+          errors += 1
+        else:
+          warnings += 1
+        failure = Failure(
+          assertion.id, assertion.flag, assertion.text,
+          context=rule.context.query, test=assertion.test.query,
+          source=Path(self.filename).name
+        )
+        if report is None:
+          log_failure(failure)
+        else:
+          failure.location = location(node, self.namespaces)
+          report.add(failure)
+    return errors, warnings
+
+# parallel evaluation, across a pool of forked processes
+
+MIN_SHARD_SIZE = 250
+SHARDS_PER_JOB = 4
+
+WALK = None # the walk that is being sharded, inherited by forked processes
+
+def _walk_shard(shard):
+  schematron, walk, nodes, first = WALK
+  start, end, part = shard
+  if part is not None: # skip the other parts of the assertions on the first node
+    document, patterns, labels, scopes, applicable, skip, results, debug = walk
+    skip = set(skip or ()) | set(first[:part[0]]) | set(first[part[1]:])
+    walk = (document, patterns, labels, scopes, applicable, skip, results, debug)
+  report = Report()
+  errors, warnings = schematron._walk(walk, nodes[start:end], None, None, report)
+  return errors, warnings, report.failures
+
+SCHEMATRONS = {}
+
+def compile_schematron(schematron_filename, phase=None) -> CompiledSchematron:
+  """
+  compiles a Schematron file once, reusing it for subsequent validations, only
+  including the patterns of a phase, see `phases`
+  """
+  key = str(Path(schematron_filename).resolve())
+  if phases.key(phase) is not None:
+    key = (key, phases.key(phase))
+  if key not in SCHEMATRONS:
+    SCHEMATRONS[key] = CompiledSchematron(schematron_filename, phase=phase)
+  return SCHEMATRONS[key]
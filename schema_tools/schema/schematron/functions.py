@@ -6,6 +6,10 @@ It’s important to note that stubs for all functions in the PEPPOL-EN16931-UBL
 
 # ruff: noqa: F841
 
+import re
+
+from decimal import Decimal, InvalidOperation
+
 from elementpath.xpath3 import XPath3Parser
 
 import logging
@@ -29,14 +33,108 @@ def evaluate_mod97_0208_function(self, context):
 
 @method(function("slack", nargs=3,
   sequence_types=('xs:decimal', 'xs:decimal', 'xs:decimal', 'xs:boolean')))
-def evaluate_slack_function(self, context):
+def evaluate_slack_function(self, context=None):
   if self.context is not None:
       context = self.context
-  exp = self.get_argument(context, default=0.0, cls=(float,int))
-  val = self.get_argument(context, default=0.0, cls=(float,int))
-  slack = self.get_argument(context, default=0.0, cls=(float,int))
+  exp, val, slack = [ _decimal(self, context, index) for index in range(3) ]
+  if exp is None or val is None or slack is None:
+    return False
   return (exp + slack) >= val and (exp - slack) <= val
 
+def _decimal(token, context, index):
+  """
+  returns an argument as xs:decimal, atomizing nodes, or None if it's empty or
+  not a number
+  """
+  value = token.data_value(token.get_argument(context, index=index))
+  if value is None or isinstance(value, bool):
+    return None
+  try:
+    number = Decimal(str(value))
+  except InvalidOperation:
+    return None
+  return None if number.is_nan() else number
+
+# code lists are checked using the idiom
+#   contains(' AA AB AC ', concat(' ', value, ' '))
+# which is rewritten into a call to code-list-contains, testing membership of a
+# set of codes, parsed once per code list
+
+CODE_LISTS = {}
+
+def code_list(codes):
+  """
+  returns the set of codes in a space separated code list, that are enclosed
+  in spaces
+  """
+  if codes not in CODE_LISTS:
+    CODE_LISTS[codes] = frozenset(codes.split(" ")[1:-1])
+  return CODE_LISTS[codes]
+
+@method(function("code-list-contains", nargs=2,
+  sequence_types=('xs:string', 'xs:anyAtomicType?', 'xs:boolean')))
+def evaluate_code_list_contains_function(self, context=None):
+  if self.context is not None:
+      context = self.context
+  codes = self.get_argument(context, default='', cls=str)
+  value = self.string_value(self.get_argument(context, index=1))
+  if not value or " " in value:
+    # only single codes are in the set, fall back to the original substring test
+    return f" {value} " in codes
+  return value in code_list(codes)
+
+CODE_LIST_IDIOM = re.compile(
+  r"""contains\(\s*('[^']*'|"[^"]*")\s*,\s*concat\(\s*(?:' '|" ")\s*,"""
+)
+CODE_LIST_END = re.compile(r"""\s*(?:' '|" ")\s*\)\s*\)""")
+
+def rewrite_code_lists(query):
+  """
+  rewrites code list membership tests in a query into calls to
+  code-list-contains
+  """
+  result = []
+  start  = 0
+  for match in CODE_LIST_IDIOM.finditer(query):
+    if match.start() < start:
+      continue
+    value_end = _argument_end(query, match.end())
+    if value_end is None:
+      continue
+    end = CODE_LIST_END.match(query, value_end + 1)
+    if not end:
+      continue
+    result.append(query[start:match.start()])
+    result.append(
+      f"code-list-contains({match.group(1)},{query[match.end():value_end]})"
+    )
+    start = end.end()
+  result.append(query[start:])
+  return "".join(result)
+
+def _argument_end(query, start):
+  """
+  returns the index of the comma ending the function argument starting at start
+  """
+  depth = 0
+  quote = None
+  for index in range(start, len(query)):
+    char = query[index]
+    if quote:
+      if char == quote:
+        quote = None
+    elif char in "'\"":
+      quote = char
+    elif char in "([":
+      depth += 1
+    elif char in ")]":
+      if depth == 0:
+        return None
+      depth -= 1
+    elif char == "," and depth == 0:
+      return index
+  return None
+
 # below are stubs of functions without implementation
 # many of these are not (yet) applicable
 
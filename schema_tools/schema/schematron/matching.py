@@ -0,0 +1,210 @@
+"""
+Matching of XML elements against Schematron rule contexts.
+
+Rule contexts are XSLT patterns: instead of selecting all nodes for every rule context, every element is checked against the contexts, walking up its ancestors, following the steps of the pattern from right to left. Such a pattern matches an element if it would be selected by evaluating the pattern with some ancestor as context, which means that also relative patterns, e.g. `ubl:Invoice`, match anywhere in the document.
+
+Patterns consisting of (unions of) paths of element name tests, with child and descendant axes and non-positional predicates, are compiled into matchers. Other patterns aren't and are evaluated as an XPath query.
+
+Matchers also expose the element names a document must contain for them to match: a list of alternative sets of names, one of which must be present. This allows to skip rules that can't fire for a document, before matching any element.
+"""
+
+import logging
+from copy import copy
+
+import elementpath
+from elementpath import ElementNode
+from elementpath.datatypes import NumericProxy
+
+from schema_tools.schema.schematron.analysis import document_subexpressions, positional
+from schema_tools.schema.schematron.xpath import share
+
+logger = logging.getLogger(__name__)
+
+class Unmatchable(Exception):
+  """
+  raised when a pattern can't be decided for an element, e.g. due to a positional
+  predicate
+  """
+
+class UnsupportedPattern(Exception):
+  """
+  raised when a pattern can't be compiled into a matcher
+  """
+
+class Step:
+  """
+  an element name test, with optional predicates, None matching any element
+  """
+  def __init__(self, name=None, predicates=None):
+    self.name       = name
+    self.predicates = predicates or []
+
+  def matches(self, node, document, variables):
+    if not isinstance(node, ElementNode):
+      return False
+    if self.name is not None and node.name != self.name:
+      return False
+    return all(
+      predicate(node, document, variables) for predicate in self.predicates
+    )
+
+  def with_predicate(self, predicate):
+    return Step(self.name, self.predicates + [ predicate ])
+
+  @property
+  def names(self):
+    return None if self.name is None else { self.name }
+
+  @property
+  def requires(self):
+    return [ frozenset() if self.name is None else frozenset({ self.name }) ]
+
+class Path:
+  """
+  a step, preceded by a parent ("/") or ancestor ("//") path, or by the document
+  root if no path is given
+  """
+  def __init__(self, axis, step, path=None):
+    self.axis = axis
+    self.step = step
+    self.path = path
+
+  def matches(self, node, document, variables):
+    if not self.step.matches(node, document, variables):
+      return False
+    parent = node.parent
+    if self.path is None:
+      # absolute path: "/step" requires the root element, "//step" any element
+      return self.axis == "//" or not isinstance(parent, ElementNode)
+    if self.axis == "/":
+      return self.path.matches(parent, document, variables)
+    while isinstance(parent, ElementNode):
+      if self.path.matches(parent, document, variables):
+        return True
+      parent = parent.parent
+    return False
+
+  def with_predicate(self, predicate):
+    return Path(self.axis, self.step.with_predicate(predicate), self.path)
+
+  @property
+  def names(self):
+    return self.step.names
+
+  @property
+  def requires(self):
+    if self.path is None:
+      return self.step.requires
+    return [
+      step | path for step in self.step.requires for path in self.path.requires
+    ]
+
+class Union:
+  def __init__(self, *alternatives):
+    self.alternatives = alternatives
+
+  def matches(self, node, document, variables):
+    return any(
+      alternative.matches(node, document, variables)
+      for alternative in self.alternatives
+    )
+
+  def with_predicate(self, predicate):
+    return Union(*[
+      alternative.with_predicate(predicate) for alternative in self.alternatives
+    ])
+
+  @property
+  def names(self):
+    names = set()
+    for alternative in self.alternatives:
+      alternative_names = alternative.names
+      if alternative_names is None:
+        return None
+      names |= alternative_names
+    return names
+
+  @property
+  def requires(self):
+    return [
+      names for alternative in self.alternatives for names in alternative.requires
+    ]
+
+class Predicate:
+  """
+  a predicate, evaluated with the element as context item. Parts that only
+  depend on the document, e.g. absolute paths, are evaluated once per document.
+  Positional predicates aren't supported.
+  """
+  def __init__(self, token):
+    if token.label == "literal" and not isinstance(token.value, str):
+      raise UnsupportedPattern(f"positional predicate '{token.source}'")
+    if positional(token):
+      raise UnsupportedPattern(f"positional predicate '{token.source}'")
+    self.token = token
+    for subexpression in document_subexpressions(token):
+      share(subexpression, context_free=True)
+
+  def __call__(self, node, document, variables):
+    context = document.context(node, variables, self.token.parser.namespaces)
+    try:
+      result = list(self.token.select(copy(context)))
+    except elementpath.exceptions.ElementPathError as ex:
+      logger.warning(f"can't evaluate predicate '{self.token.source}': {ex}")
+      return False
+    if len(result) == 1 and isinstance(result[0], NumericProxy):
+      raise Unmatchable(f"positional predicate '{self.token.source}'")
+    return self.token.boolean_value(result)
+
+def compile_matcher(expression):
+  """
+  compiles a rule context `Expression` into a matcher, or returns None if the
+  pattern isn't supported
+  """
+  if expression.token is None:
+    return None
+  try:
+    return _compile(expression.token, expression.namespaces)
+  except UnsupportedPattern as ex:
+    logger.debug(f"no matcher for '{expression.query}': {ex}")
+    return None
+
+def _compile(token, namespaces):
+  if token.symbol in ("|", "union"):
+    alternatives = []
+    for alternative in token:
+      alternative = _compile(alternative, namespaces)
+      if isinstance(alternative, Union): # flatten a | b | c
+        alternatives.extend(alternative.alternatives)
+      else:
+        alternatives.append(alternative)
+    return Union(*alternatives)
+  if token.symbol == "(" and len(token) == 1:
+    return _compile(token[0], namespaces)
+  if token.symbol == "[":
+    return _compile(token[0], namespaces).with_predicate(Predicate(token[1]))
+  if token.symbol in ("/", "//"):
+    if len(token) == 1:
+      return Path(token.symbol, _step(token[0], namespaces))
+    if len(token) == 2:
+      return Path(
+        token.symbol, _step(token[1], namespaces), _compile(token[0], namespaces)
+      )
+    raise UnsupportedPattern("document node")
+  # a relative step matches anywhere in the document
+  return Path("//", _step(token, namespaces))
+
+def _step(token, namespaces):
+  if token.symbol == "[":
+    return _step(token[0], namespaces).with_predicate(Predicate(token[1]))
+  if token.symbol == "*" and len(token) == 0:
+    return Step()
+  if token.symbol == ":" and token[0].symbol == "(name)" and token[1].symbol == "(name)":
+    prefix, name = token[0].value, token[1].value
+    if prefix not in namespaces:
+      raise UnsupportedPattern(f"unknown prefix '{prefix}'")
+    return Step(f"{{{namespaces[prefix]}}}{name}")
+  if token.symbol == "(name)":
+    namespace = namespaces.get("")
+    return Step(f"{{{namespace}}}{token.value}" if namespace else token.value)
+  raise UnsupportedPattern(f"unsupported step '{token.source}'")
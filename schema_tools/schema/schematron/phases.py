@@ -0,0 +1,71 @@
+"""
+Schematron phases.
+
+A phase selects a subset of the patterns of a Schematron, so that only those are compiled and evaluated. A phase can be:
+- None or `#ALL`: all patterns
+- `#DEFAULT`: the phase named by the `defaultPhase` of the Schematron, or all patterns
+- the id of a `phase` defined in the Schematron, activating its patterns
+- a selection: a comma separated string, or a list, of pattern ids, `#<index>` of patterns without an id, or glob patterns of assertion ids, e.g. `PEPPOL-EN16931-R0*`
+
+Patterns selected as a whole keep all their rules. Of other patterns, only the assertions with a matching id are kept. Rules without such assertions are kept if they precede a rule that is kept, since a node matched by an earlier rule of a pattern isn't matched by later ones.
+"""
+
+from fnmatch import fnmatchcase
+
+
+def selectors(definition, phase):
+  """
+  returns the selectors of a phase, or None if it selects all patterns
+  """
+  if phase == "#DEFAULT":
+    phase = definition.get("default_phase")
+  if phase is None or phase == "#ALL":
+    return None
+  if isinstance(phase, str):
+    if phase in definition.get("phases", {}):
+      return list(definition["phases"][phase])
+    phase = phase.split(",")
+  return [ selector.strip() for selector in phase if selector.strip() ]
+
+def selected(name, selectors):
+  return name is not None and any(
+    fnmatchcase(name, selector) for selector in selectors
+  )
+
+def select(definition, phase=None):
+  """
+  returns a definition with only the patterns, rules and assertions of a phase
+  """
+  active = selectors(definition, phase)
+  if active is None:
+    return definition
+  patterns = []
+  for index, pattern in enumerate(definition["patterns"]):
+    if selected(pattern["id"], active) or f"#{index}" in active:
+      patterns.append(pattern)
+      continue
+    rules = [
+      {
+        **rule,
+        "assertions" : [
+          assertion for assertion in rule["assertions"]
+          if selected(assertion["id"], active)
+        ]
+      }
+      for rule in pattern["rules"]
+    ]
+    while rules and not rules[-1]["assertions"]:
+      rules.pop()
+    if rules:
+      patterns.append({ **pattern, "rules" : rules })
+  return { **definition, "patterns" : patterns }
+
+def key(phase):
+  """
+  returns a hashable representation of a phase, or None for all patterns
+  """
+  if phase is None or phase == "#ALL":
+    return None
+  if isinstance(phase, str):
+    return phase
+  return ",".join(phase)
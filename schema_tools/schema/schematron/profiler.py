@@ -0,0 +1,51 @@
+"""
+Profiling of Schematron validation.
+
+A `Profiler` can be passed to `CompiledSchematron.evaluate` to record the wall time and number of calls of every pattern, rule context, `let` variable and assertion. Without a profiler, no timing is performed at all.
+"""
+
+import json
+
+KINDS = [ "pattern", "context", "let", "assert" ]
+
+class Profiler:
+  """
+  records wall time and calls of the parts of Schematron validations
+  """
+  def __init__(self):
+    self.records = {}
+
+  def record(self, kind, name, seconds):
+    key = (kind, name)
+    calls, total = self.records.get(key, (0, 0.0))
+    self.records[key] = (calls + 1, total + seconds)
+
+  def report(self, kind=None):
+    """
+    returns all records, optionally of one kind, slowest first
+    """
+    report = [
+      {
+        "kind"    : record_kind,
+        "name"    : name,
+        "calls"   : calls,
+        "total_ms": round(total * 1000, 3),
+        "mean_ms" : round(total * 1000 / calls, 3)
+      }
+      for (record_kind, name), (calls, total) in self.records.items()
+      if kind is None or record_kind == kind
+    ]
+    return sorted(report, key=lambda record: record["total_ms"], reverse=True)
+
+  def top(self, n=20, kind=None):
+    """
+    returns the n slowest records, optionally of one kind
+    """
+    return self.report(kind)[:n]
+
+  def save(self, filename):
+    """
+    exports all records to a JSON file, grouped by kind
+    """
+    with open(filename, "w") as fp:
+      json.dump({ kind : self.report(kind) for kind in KINDS }, fp, indent=2)
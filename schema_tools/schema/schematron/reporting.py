@@ -0,0 +1,200 @@
+"""
+Structured validation results.
+
+A `Report` collects the failed assertions of one or more validations, without formatting or logging them. It can be rendered on demand as SVRL, the Schematron Validation Report Language, as JSON, or as a rich table, or be logged as was done before.
+"""
+
+import json
+import logging
+from xml.etree import ElementTree
+
+from elementpath import AttributeNode, ElementNode, TextNode
+from rich.table import Table
+
+logger = logging.getLogger(__name__)
+
+SVRL = "http://purl.oclc.org/dsdl/svrl"
+
+FORMATS = [ "svrl", "json", "rich" ]
+
+class Failure:
+  """
+  a failed assertion, or an XSD error, with the location of the context node
+  """
+  def __init__(
+    self, id, flag, message, location=None, context=None, test=None, source=None
+  ):
+    self.id       = id
+    self.flag     = flag
+    self.message  = message
+    self.location = location
+    self.context  = context
+    self.test     = test
+    self.source   = source
+
+  def __repr__(self):
+    return f"Failure({self.id}, {self.flag}, {self.location})"
+
+  @property
+  def fatal(self):
+    return self.flag == "fatal"
+
+  def as_dict(self):
+    return {
+      "id"       : self.id,
+      "flag"     : self.flag,
+      "location" : self.location,
+      "context"  : self.context,
+      "test"     : self.test,
+      "message"  : self.message,
+      "source"   : self.source
+    }
+
+class Report:
+  """
+  the failures of a validation, renderable as SVRL, JSON or rich text
+  """
+  def __init__(self):
+    self.failures   = []
+    self.namespaces = {}
+    self.complete   = True
+    self.skipped    = [] # ids of assertions that weren't evaluated
+
+  def __repr__(self):
+    return f"Report(errors={self.errors}, warnings={self.warnings})"
+
+  def add(self, failure):
+    self.failures.append(failure)
+
+  @property
+  def errors(self):
+    return sum(failure.fatal for failure in self.failures)
+
+  @property
+  def warnings(self):
+    return len(self.failures) - self.errors
+
+  @property
+  def valid(self):
+    """
+    True if no errors were found, False if some were, or None if the validation
+    stopped early without finding errors
+    """
+    if self.errors:
+      return False
+    return True if self.complete else None
+
+  def as_dict(self):
+    return {
+      "valid"    : self.valid,
+      "complete" : self.complete,
+      "errors"   : self.errors,
+      "warnings" : self.warnings,
+      "skipped"  : self.skipped,
+      "failures" : [ failure.as_dict() for failure in self.failures ]
+    }
+
+  def json(self, indent=2):
+    return json.dumps(self.as_dict(), indent=indent)
+
+  def svrl(self):
+    """
+    returns the failures as an SVRL document
+    """
+    ElementTree.register_namespace("svrl", SVRL)
+    root = ElementTree.Element(f"{{{SVRL}}}schematron-output")
+    for prefix, uri in self.namespaces.items():
+      ElementTree.SubElement(
+        root, f"{{{SVRL}}}ns-prefix-in-attribute-values", prefix=prefix, uri=uri
+      )
+    for failure in self.failures:
+      attributes = {
+        name : value for name, value in [
+          ("id", failure.id), ("flag", failure.flag), ("test", failure.test),
+          ("location", failure.location)
+        ] if value is not None
+      }
+      element = ElementTree.SubElement(root, f"{{{SVRL}}}failed-assert", attributes)
+      ElementTree.SubElement(element, f"{{{SVRL}}}text").text = failure.message
+    ElementTree.indent(root)
+    return ElementTree.tostring(root, encoding="unicode")
+
+  def rich(self):
+    """
+    returns the failures as a rich table
+    """
+    table = Table()
+    for column in [ "flag", "id", "location", "message" ]:
+      table.add_column(column)
+    for failure in self.failures:
+      color = "red" if failure.fatal else "yellow"
+      table.add_row(
+        f"[{color}]{failure.flag}[/{color}]", failure.id or "",
+        failure.location or "", failure.message
+      )
+    return table
+
+  def render(self, format="json"):
+    if format not in FORMATS:
+      raise ValueError(f"unknown report format '{format}', expected one of {FORMATS}")
+    return getattr(self, format)()
+
+  def log(self):
+    """
+    logs every failure, as rich markup
+    """
+    for failure in self.failures:
+      log_failure(failure)
+
+def log_failure(failure):
+  color = "red" if failure.fatal else "yellow"
+  logger_func = logger.error if failure.fatal else logger.warning
+  logger_func(f"""[{color}]{failure.message}[/{color}]
+  [blue]context[/blue]: {failure.context}
+  [blue]query[/blue]  : {failure.test}""",
+    extra={"markup": True}
+  )
+
+def location(node, namespaces=None):
+  """
+  returns an XPath locating an elementpath node, e.g.
+  `/ubl:Invoice[1]/cac:InvoiceLine[2]`, using the prefixes of the namespaces
+  """
+  steps = []
+  if isinstance(node, AttributeNode):
+    steps.append("@" + qualified(node.name, namespaces))
+    node = node.parent
+  elif isinstance(node, TextNode):
+    steps.append("text()")
+    node = node.parent
+  while isinstance(node, ElementNode):
+    element = node.value
+    parent  = node.parent
+    index   = 1
+    if isinstance(parent, ElementNode):
+      for sibling in parent.value:
+        if sibling is element:
+          break
+        if sibling.tag == element.tag:
+          index += 1
+    steps.append(step(element.tag, index, namespaces))
+    node = parent
+  return "/" + "/".join(reversed(steps))
+
+def step(tag, index, namespaces=None):
+  """
+  returns a location step for the index-th element with a (Clark notation) tag
+  """
+  return f"{qualified(tag, namespaces)}[{index}]"
+
+def qualified(tag, namespaces=None):
+  """
+  returns a (Clark notation) name, using the prefix of its namespace
+  """
+  if not isinstance(tag, str) or not tag.startswith("{"):
+    return tag
+  uri, name = tag[1:].split("}", 1)
+  for prefix, namespace in (namespaces or {}).items():
+    if namespace == uri and prefix:
+      return f"{prefix}:{name}"
+  return f"*:{name}"
@@ -0,0 +1,122 @@
+"""
+Incremental re-validation of edited documents.
+
+A `Session` validates successive versions of a document, e.g. after every edit in an editor, reusing the results of assertions of the previous validation, when they can't have changed.
+
+Every element of a document gets a fingerprint, a hash of its name, attributes, text and the fingerprints of its children, which changes if anything in its subtree changes. Assertions that only depend on the subtree of their context node and on document level variables, see `Rule`, are looked up by their context node's fingerprint and the values of those variables. Only assertions on changed subtrees, and assertions that look outside of their subtree, are evaluated again. Rule contexts are still matched against all elements.
+"""
+
+import logging
+
+from elementpath import ElementNode, XPathNode
+
+from schema_tools import xml
+from schema_tools.schema.schematron.compiler import compile_schematron
+from schema_tools.schema.schematron.reporting import Report
+
+logger = logging.getLogger(__name__)
+
+def fingerprints(xml_root):
+  """
+  returns the fingerprints of all elements of an ElementTree, by their id
+  """
+  found = {}
+  def fingerprint(element):
+    children = tuple(
+      (fingerprint(child), child.tail) for child in element
+    )
+    found[id(element)] = hash((
+      element.tag, tuple(sorted(element.attrib.items())), element.text, children
+    ))
+    return found[id(element)]
+  fingerprint(xml_root)
+  return found
+
+class Results:
+  """
+  results of assertions by their context node's fingerprint and the values of
+  their dependencies, looked up in those of a previous validation
+  """
+  def __init__(self, fingerprints, previous=None):
+    self.fingerprints = fingerprints
+    self.previous     = previous or {}
+    self.current      = {}
+    self.hits         = 0
+    self.misses       = 0
+
+  def key(self, assertion, node, variables):
+    """
+    returns the key of an assertion on a node, or None if it can't be cached
+    """
+    fingerprint = self.fingerprints.get(id(node.value))
+    if fingerprint is None:
+      return None
+    try:
+      key = (
+        assertion, fingerprint,
+        tuple(self.value(variables[name]) for name in assertion.dependencies)
+      )
+      hash(key)
+    except (KeyError, TypeError): # e.g. an array or map as value
+      return None
+    return key
+
+  def value(self, value):
+    """
+    returns a hashable representation of the value of a variable, representing
+    elements by their fingerprint
+    """
+    if isinstance(value, list):
+      return tuple(self.value(item) for item in value)
+    if isinstance(value, ElementNode):
+      return ("element", self.fingerprints[id(value.value)])
+    if isinstance(value, XPathNode):
+      return (value.__class__.__name__, value.name, value.string_value)
+    return value
+
+  def __contains__(self, key):
+    if key in self.current:
+      return True
+    if key in self.previous:
+      self.current[key] = self.previous[key]
+      self.hits += 1
+      return True
+    self.misses += 1
+    return False
+
+  def __getitem__(self, key):
+    return self.current[key]
+
+  def __setitem__(self, key, result):
+    self.current[key] = result
+
+class Session:
+  """
+  validates successive versions of a document against Schematrons, reusing
+  results of the previous version
+  """
+  def __init__(self, schematrons, phase=None):
+    self.schematrons = [
+      compile_schematron(schematron, phase) for schematron in schematrons
+    ]
+    self.results     = {}
+
+  def validate(self, xml_root, report=None, budget=None) -> Report:
+    """
+    validates a (new version of a) document, an ElementTree or `xml.Document`,
+    returning a `Report`
+    """
+    if report is None:
+      report = Report()
+    element = xml_root.root if isinstance(xml_root, xml.Document) else xml_root
+    results = Results(fingerprints(element), self.results)
+    for schematron in self.schematrons:
+      report.namespaces.update(schematron.namespaces)
+      schematron.evaluate(xml_root, budget=budget, report=report, results=results)
+    # only keep the results of this version, which is the next previous one
+    self.results = results.current
+    logger.info(
+      f"reused {results.hits} of {results.hits + results.misses} cacheable "
+      "assertion results"
+    )
+    return report
@@ -0,0 +1,97 @@
+"""
+Streaming validation of huge documents, in roughly constant memory.
+
+Instead of loading a whole document, it is parsed incrementally using `iterparse`. Every line, i.e. a `cac:InvoiceLine` or `cac:CreditNoteLine` child of the root element, is validated as soon as it has been parsed, in a document holding the header, i.e. all preceding elements that aren't lines, and that single line, after which the line is discarded. Finally, the rules outside of lines are validated against the header skeleton.
+
+This has some limitations:
+- assertions outside of lines that refer to lines, e.g. sums over all lines, can't be evaluated on the skeleton, and are skipped. They are listed in the `skipped` of the report.
+- assertions within lines only see their own line, and the header elements preceding the lines.
+"""
+
+import logging
+from xml.etree import ElementTree
+
+from schema_tools.schema.schematron.compiler import compile_schematron
+from schema_tools.schema.schematron.reporting import Report, step
+
+logger = logging.getLogger(__name__)
+
+CAC = "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+
+LINES = { f"{{{CAC}}}InvoiceLine", f"{{{CAC}}}CreditNoteLine" }
+
+def iter_lines(source, lines=LINES):
+  """
+  parses an XML file incrementally, yielding the root element and every line,
+  i.e. a child of the root element with one of the given names, once parsed.
+  Lines are removed from the root element after they have been yielded.
+  Finally the root element is yielded without a line.
+  """
+  depth = 0
+  root  = None
+  for event, element in ElementTree.iterparse(source, events=("start", "end")):
+    if event == "start":
+      depth += 1
+      if root is None:
+        root = element
+      continue
+    depth -= 1
+    if depth == 1 and element.tag in lines:
+      yield root, element
+      root.remove(element)
+      element.clear()
+  yield root, None
+
+def validate_stream(
+  source, schematrons, lines=LINES, report=None, budget=None, phase=None
+) -> Report:
+  """
+  validates an XML file against Schematrons, line by line, returning a `Report`
+  """
+  if report is None:
+    report = Report()
+  compiled = [
+    compile_schematron(schematron, phase) for schematron in schematrons
+  ]
+  for schematron in compiled:
+    report.namespaces.update(schematron.namespaces)
+  counts = {}
+  inside = set() # the names of all elements within lines
+  for root, line in iter_lines(source, lines):
+    if budget is not None and budget.check():
+      break
+    if line is not None:
+      counts[line.tag] = counts.get(line.tag, 0) + 1
+      inside.update(element.tag for element in line.iter())
+      for schematron in compiled:
+        failures = len(report.failures)
+        schematron.evaluate(root, budget=budget, report=report, within=line)
+        relocate(
+          report.failures[failures:], root, line, counts[line.tag],
+          schematron.namespaces
+        )
+      continue
+    # the header skeleton, without the assertions that need the lines
+    for schematron in compiled:
+      spanning = schematron.spanning(lines, inside)
+      schematron.evaluate(root, budget=budget, report=report, skip=set(spanning))
+      report.skipped.extend(assertion.id for assertion in spanning)
+  if report.skipped or (budget is not None and budget.exhausted):
+    report.complete = False # skipped assertions might have failed
+  logger.info(
+    f"validated {sum(counts.values())} lines and the header, "
+    f"skipping {len(report.skipped)} assertions spanning lines"
+  )
+  return report
+
+def relocate(failures, root, line, index, namespaces):
+  """
+  fixes the location of failures in a line, which is the only line in the
+  document it was validated in, to its index in the original document
+  """
+  parent = "/" + step(root.tag, 1, namespaces)
+  alone  = f"{parent}/{step(line.tag, 1, namespaces)}"
+  actual = f"{parent}/{step(line.tag, index, namespaces)}"
+  for failure in failures:
+    if failure.location and failure.location.startswith(alone):
+      failure.location = actual + failure.location[len(alone):]
@@ -0,0 +1,209 @@
+"""
+Ahead-of-time compilation of a Schematron into a Python module.
+
+The generated module holds the definition of the Schematron, so importing it doesn't require reading and parsing the Schematron XML file. Simple assertion tests, consisting of existence checks, comparisons with string literals and counts of child element and attribute paths, are also translated into Python functions, operating directly on the ElementTree element of the context node. A bare path as a test isn't translated, since its outcome is the value of the first item it selects, see `Expression.evaluate`, not its effective boolean value. All other queries are parsed into elementpath tokens when the module is imported.
+
+example:
+  % schema-tools schematron compile CEN-EN16931-UBL.sch -o rules_cen.py
+"""
+
+import importlib.util
+import logging
+import pprint
+from pathlib import Path
+
+from schema_tools.schema.schematron.compiler import (
+  SCHEMATRONS,
+  CompiledSchematron,
+  read_schematron,
+)
+from schema_tools.schema.schematron.xpath import Expression, shared_parser
+
+logger = logging.getLogger(__name__)
+
+class Untranslatable(Exception):
+  """
+  raised when a (part of a) query can't be translated into Python
+  """
+
+# runtime support for generated functions
+
+def text(item):
+  """
+  returns the string value of an element or attribute value
+  """
+  return item if isinstance(item, str) else "".join(item.itertext())
+
+def attributes(elements, name):
+  """
+  returns the values of an attribute of elements, if present
+  """
+  return [
+    element.get(name) for element in elements if element.get(name) is not None
+  ]
+
+# translation of queries
+
+COMPARISONS = {
+  "="  : "==",
+  "!=" : "!=",
+  "<"  : "<",
+  "<=" : "<=",
+  ">"  : ">",
+  ">=" : ">="
+}
+
+def translate(query, namespaces):
+  """
+  translates an assertion test into a Python expression on `element`, the
+  ElementTree element of the context node, or returns None
+  """
+  expression = Expression(query, parser=shared_parser(namespaces))
+  if expression.token is None:
+    return None
+  token = expression.token
+  while token.symbol == "(" and len(token) == 1:
+    token = token[0]
+  try:
+    return _boolean(token, namespaces, bare=False)
+  except Untranslatable as ex:
+    logger.debug(f"not translating '{query}': {ex}")
+    return None
+
+def _boolean(token, namespaces, bare=True):
+  if token.symbol in ("and", "or"):
+    left, right = _boolean(token[0], namespaces), _boolean(token[1], namespaces)
+    return f"({left} {token.symbol} {right})"
+  if token.symbol == "not" and len(token) == 1:
+    return f"(not {_boolean(token[0], namespaces)})"
+  if token.symbol == "exists" and len(token) == 1:
+    return f"bool({_path(token[0], namespaces)})"
+  if token.symbol in ("true", "false") and len(token) == 0:
+    return str(token.symbol == "true")
+  if token.symbol == "(" and len(token) == 1:
+    return _boolean(token[0], namespaces)
+  if token.symbol in COMPARISONS and len(token) == 2:
+    return _comparison(token, namespaces)
+  if not bare:
+    raise Untranslatable(f"bare path '{token.source}'")
+  # the effective boolean value of a path is true if it selects anything
+  return f"bool({_path(token, namespaces)})"
+
+def _comparison(token, namespaces):
+  operator = COMPARISONS[token.symbol]
+  left, right = token[0], token[1]
+  if left.symbol == "count" and len(left) == 1 and right.symbol == "(integer)":
+    return f"(len({_path(left[0], namespaces)}) {operator} {right.value!r})"
+  if token.symbol not in ("=", "!="):
+    raise Untranslatable(f"comparison '{token.source}'")
+  if left.symbol == "(string)":
+    left, right = right, left
+  if right.symbol != "(string)":
+    raise Untranslatable(f"comparison '{token.source}'")
+  # general comparison: true if any item compares true
+  items = _path(left, namespaces)
+  return f"any(text(item) {operator} {right.value!r} for item in {items})"
+
+def _path(token, namespaces):
+  """
+  translates a relative path of child elements, optionally ending with an
+  attribute, into a Python expression returning a list of elements or values
+  """
+  steps = _steps(token, namespaces)
+  attribute = None
+  if steps and steps[-1].startswith("@"):
+    attribute = steps.pop()[1:]
+  if steps in ([], [ "." ]):
+    elements = "[ element ]"
+  else:
+    elements = f"element.findall({'/'.join(steps)!r}, NAMESPACES)"
+  if attribute:
+    return f"attributes({elements}, {attribute!r})"
+  return elements
+
+def _steps(token, namespaces):
+  if token.symbol == "/" and len(token) == 2:
+    steps = _steps(token[0], namespaces)
+    if steps and steps[-1].startswith("@"):
+      raise Untranslatable(f"path '{token.source}'")
+    return steps + _steps(token[1], namespaces)
+  if token.symbol == ".":
+    return [ "." ]
+  if token.symbol == "@" and len(token) == 1:
+    if token[0].symbol != "(name)":
+      raise Untranslatable(f"attribute '{token.source}'")
+    return [ f"@{token[0].value}" ]
+  if token.symbol == ":" and token[0].symbol == "(name)" and \
+     token[1].symbol == "(name)":
+    if token[0].value not in namespaces:
+      raise Untranslatable(f"prefix '{token[0].value}'")
+    return [ f"{token[0].value}:{token[1].value}" ]
+  if token.symbol == "(name)" and "" not in namespaces:
+    return [ token.value ]
+  raise Untranslatable(f"step '{token.source}'")
+
+# generation of a module
+
+def generate(schematron_filename):
+  """
+  returns the source of a Python module, holding the definition of a
+  Schematron, with translated assertion tests
+  """
+  definition = read_schematron(schematron_filename)
+  namespaces = definition["namespaces"]
+  functions  = []
+  for pattern in definition["patterns"]:
+    for rule in pattern["rules"]:
+      for assertion in rule["assertions"]:
+        translated = translate(assertion["test"], namespaces)
+        if translated is not None:
+          name = f"test_{len(functions)}"
+          functions.append(f'''
+def {name}(element):
+  # {" ".join(assertion["test"].split())}
+  return {translated}
+''')
+          assertion["function"] = Function(name)
+  total = sum(
+    len(rule["assertions"])
+    for pattern in definition["patterns"] for rule in pattern["rules"]
+  )
+  logger.info(f"translated {len(functions)} of {total} assertions")
+  return f'''"""
+generated by schema-tools from {Path(schematron_filename).name}, do not edit
+"""
+
+from schema_tools.schema.schematron.transpiler import attributes, text # noqa: F401
+from schema_tools.schema.schematron.compiler   import CompiledSchematron
+
+FILENAME = {Path(schematron_filename).name!r}
+
+NAMESPACES = {pprint.pformat(namespaces, indent=2, sort_dicts=False)}
+{"".join(functions)}
+DEFINITION = {pprint.pformat(definition, indent=2, width=100, sort_dicts=False)}
+
+SCHEMATRON = CompiledSchematron(FILENAME, DEFINITION)
+'''
+
+class Function:
+  """
+  a reference to a generated function, represented by its name
+  """
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return self.name
+
+def load(module_filename, schematron_filename=None) -> CompiledSchematron:
+  """
+  imports a generated module, returning its compiled Schematron, optionally
+  registering it as the compiled version of a Schematron file
+  """
+  name   = Path(module_filename).stem
+  spec   = importlib.util.spec_from_file_location(name, module_filename)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  if schematron_filename:
+    SCHEMATRONS[str(Path(schematron_filename).resolve())] = module.SCHEMATRON
+  return module.SCHEMATRON
@@ -0,0 +1,301 @@
+"""
+XPath support for Schematron validation, wrapping `elementpath` with some sensible defaults and error handling.
+
+Queries can be compiled once into an `Expression`, holding the parsed token tree, and evaluated many times, avoiding to tokenize and parse the same query over and over again.
+
+In the same way, an XML document can be prepared once into an `XPathDocument`, holding the elementpath node tree, which is otherwise rebuilt for every evaluation.
+"""
+
+from __future__ import annotations
+
+import copy
+import json
+import logging
+from xml.etree import ElementTree
+
+import elementpath
+from elementpath import ElementNode, XPathContext, get_node_tree
+from elementpath.xpath3 import XPath3Parser
+
+# this injects custom functions in the parser
+from schema_tools.schema.schematron.functions import rewrite_code_lists
+
+logger = logging.getLogger(__name__)
+
+SCHEMATRON_NAMESPACES = {"":"http://purl.oclc.org/dsdl/schematron"}
+
+PARSERS = {}
+
+def shared_parser(namespaces) -> XPath3Parser:
+  """
+  returns an `XPath3Parser` for the given namespaces, shared by all callers
+  """
+  key = tuple(sorted(namespaces.items()))
+  if key not in PARSERS:
+    PARSERS[key] = XPath3Parser(namespaces)
+  return PARSERS[key]
+
+def node_tree(xml_root, namespaces=None):
+  """
+  returns the elementpath node tree of an ElementTree or of a root element,
+  which is then still given a document node as parent, see `root_node`
+  """
+  if isinstance(xml_root, ElementTree.Element):
+    return get_node_tree(ElementTree.ElementTree(xml_root), namespaces).getroot()
+  return get_node_tree(xml_root, namespaces)
+
+class XPathDocument:
+  """
+  an XML document with its elementpath node tree and XPath context, built once
+  and reused for all evaluations on the document, or given, if already built
+  """
+  def __init__(self, xml_root, namespaces=SCHEMATRON_NAMESPACES, root=None):
+    self.xml_root   = xml_root
+    self.namespaces = namespaces
+    self.root       = root
+    if root is None:
+      self.root = node_tree(xml_root, namespaces)
+    self._context   = XPathContext(self.root, namespaces)
+    self.shared     = {} # cached values of shared subexpressions, see `share`
+    self._context.shared = self.shared
+    self._elements  = None
+    self._index     = None
+    self.selections = {} # cached results of queries on the document
+
+  def _build_index(self):
+    self._elements = []
+    self._index    = {}
+    for node in self.root.iter():
+      if isinstance(node, ElementNode):
+        self._elements.append(node)
+        self._index.setdefault(node.name, []).append(node)
+
+  @property
+  def elements(self):
+    """
+    all element nodes, in document order
+    """
+    if self._elements is None:
+      self._build_index()
+    return self._elements
+
+  @property
+  def index(self):
+    """
+    element nodes by their (Clark notation) name, in document order
+    """
+    if self._index is None:
+      self._build_index()
+    return self._index
+
+  def descendants(self, name):
+    """
+    returns all elements with a given (Clark notation) name, in document order
+    """
+    return self.index.get(name, [])
+
+  @property
+  def root_node(self):
+    """
+    the document node, e.g. selected by a `/` rule context, or the root element
+    if the document doesn't have one
+    """
+    return self.root.root_node
+
+  def __repr__(self):
+    return f"XPathDocument({self.xml_root})"
+
+  def context(self, item=None, variables=None, namespaces=None) -> XPathContext:
+    """
+    returns a fresh dynamic context on the prepared node tree
+    """
+    context = copy.copy(self._context)
+    if namespaces is not None:
+      context.namespaces = namespaces
+    if item is not None:
+      context.item = context.get_context_item(item, context.namespaces)
+    if variables is None or isinstance(variables, dict):
+      context.variables = {
+        name : context.get_value(value, context.namespaces)
+        for name, value in (variables or {}).items()
+      }
+    else:
+      context.variables = Variables(variables, context)
+    return context
+
+class Variables(dict):
+  """
+  the variables of a dynamic context, resolved on first reference from a scope,
+  e.g. a lazily evaluated mapping of names to values
+  """
+  def __init__(self, scope, context):
+    super().__init__()
+    self.scope   = scope
+    self.context = context
+
+  def __missing__(self, name):
+    value = self.context.get_value(self.scope[name], self.context.namespaces)
+    self[name] = value
+    return value
+
+  def copy(self):
+    # quantified and for expressions bind their variables in a copy
+    variables = Variables(self.scope, self.context)
+    variables.update(self)
+    return variables
+
+def share(token, source=None, context_free=False):
+  """
+  caches the values of a subexpression, which is shared by many queries, per
+  document and context item, or if it is context free, per document. Only
+  documents prepared as `XPathDocument` hold such a cache.
+  """
+  evaluate, select = token.evaluate, token.select
+  source     = source or token.source
+  namespaces = tuple(sorted(token.parser.namespaces.items()))
+
+  def lookup(method, context):
+    cache = getattr(context, "shared", None)
+    if cache is None:
+      return None, None
+    if context_free:
+      return cache, (method, namespaces, source)
+    key = (method, namespaces, source, context.item)
+    try:
+      hash(key)
+    except TypeError: # e.g. an array or map as context item
+      return None, None
+    return cache, key
+
+  def shared_evaluate(context=None):
+    cache, key = lookup("evaluate", context)
+    if cache is None:
+      return evaluate(context)
+    if key not in cache:
+      cache[key] = evaluate(context)
+    value = cache[key]
+    return list(value) if isinstance(value, list) else value
+
+  def shared_select(context=None):
+    cache, key = lookup("select", context)
+    if cache is None:
+      return select(context)
+    if key not in cache:
+      cache[key] = list(select(context))
+    return iter(cache[key])
+
+  token.evaluate = shared_evaluate
+  token.select   = shared_select
+
+class Expression:
+  """
+  a compiled XPath query, holding the token tree produced by the `XPath3Parser`,
+  after rewriting known idioms into faster equivalents
+  """
+  def __init__(self, query, namespaces=SCHEMATRON_NAMESPACES, parser=None):
+    self.query  = query
+    self.source = rewrite_code_lists(query)
+    self.token  = None
+    self.error  = None
+    if parser is None:
+      parser = XPath3Parser(namespaces)
+    self.namespaces = parser.namespaces
+    try:
+      self.token = parser.parse(self.source)
+    except elementpath.exceptions.ElementPathError as ex:
+      # parse errors are reported when the expression is evaluated
+      self.error = ex
+
+  def __repr__(self):
+    return f"Expression({self.query!r})"
+
+  def __getstate__(self):
+    # token trees are bound to their parser, which doesn't survive pickling,
+    # so only the query is kept and parsed again when unpickling
+    return { "query" : self.query, "namespaces" : self.namespaces }
+
+  def __setstate__(self, state):
+    self.__init__(state["query"], parser=shared_parser(state["namespaces"]))
+
+  def evaluate(
+    self, root, context=None, variables=None, return_list=True,
+    return_node=False
+  ) -> bool | list | str:
+    """
+    evaluates the expression on a root or `XPathDocument`, optionally given a
+    context item
+    """
+    debug = logger.isEnabledFor(logging.DEBUG)
+    try:
+      if debug:
+        logger.debug(f"root={root}")
+        logger.debug(f"query={self.query}")
+        logger.debug(f"context={context}")
+      if self.error:
+        raise self.error
+      if isinstance(root, XPathDocument):
+        xpath_context = root.context(context, variables, self.namespaces)
+      else:
+        xpath_context = XPathContext(
+          root, self.namespaces, item=context, variables=variables
+        )
+      result = self.token.get_results(xpath_context)
+      if debug:
+        logger.debug(f"result={result}")
+      # return first value in list
+      if not return_list and isinstance(result, list):
+        if debug:
+          logger.debug("UNWRAPPING LIST")
+        result = result[0] if len(result) else None
+
+      # try opportunistic unwrapping of text node
+      if not return_node:
+        try:
+          return result.text
+        except AttributeError:
+          pass
+      return result
+
+    except elementpath.exceptions.ElementPathValueError as ex:
+      logger.error(ex)
+      return False
+    except (
+      elementpath.exceptions.ElementPathNameError,
+      elementpath.exceptions.ElementPathTypeError
+    ) as ex:
+      logger.warning(f"for query '{self.query}':")
+      logger.warning(f"can't perform select: {ex}")
+      logger.warning(json.dumps(variables, indent=2, default=str))
+      return [] if return_list else True
+
+def select(
+  root, query,
+  namespaces=SCHEMATRON_NAMESPACES,
+  context=None,
+  variables=None,
+  return_list=True,
+  return_node=False,
+  debug=False
+) -> bool | list | str:
+  """
+  utility function wrapping `elementpath.select` with some sensible defaults and error handling, accepting a query or a compiled `Expression` and an ElementTree or prepared `XPathDocument`
+  """
+  if not isinstance(query, Expression):
+    query = Expression(query, namespaces=namespaces)
+  return query.evaluate(
+    root, context=context, variables=variables,
+    return_list=return_list, return_node=return_node
+  )
+
+def select_find(*args, **kwargs) -> list:
+  """
+  wrapper utility function for `select`, ensuring that a list if returned
+  """
+  result = select(*args, **kwargs)
+  return result if isinstance(result,list) else []
+
+def select_query(*args, **kwargs) -> bool | list | str:
+  """
+  wrapper utility function for `select`, ensuring that a value is returned, not a list.
+  """
+  return select(*args, **kwargs, return_list=False)
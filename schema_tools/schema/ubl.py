@@ -1,39 +1,521 @@
-from xml.etree import ElementTree
-
 from pathlib import Path
 
 from importlib.resources import as_file, files
 
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+import elementpath
+import xmlschema
+
+from rich.console import Console
+
+from schema_tools        import __version__
 from schema_tools        import resources
 from schema_tools        import xml
 from schema_tools.schema import xml as xml_schema
 from schema_tools.schema import schematron
+from schema_tools.schema.schematron import compiler
+from schema_tools.schema.schematron import streaming
+
+import logging
+logger = logging.getLogger(__name__)
+
+SCHEMATRONS = [ "CEN-EN16931-UBL.sch", "PEPPOL-EN16931-UBL.sch" ]
+
+# the Schematrons that apply to a doctype, other doctypes only have their XSD
+DOCTYPE_SCHEMATRONS = { "Invoice" : SCHEMATRONS, "CreditNote" : SCHEMATRONS }
+
+MAINDOC   = "UBL-2/xsd/maindoc"
+NAMESPACE = "urn:oasis:names:specification:ubl:schema:xsd:{doctype}-2"
+
+BUNDLE_FORMAT   = 1
+BUNDLE_DOCTYPES = [ "Invoice", "CreditNote" ]
+
+def xsd(doctype):
+  """
+  returns the path of the maindoc XSD for a doctype, relative to the resources
+  """
+  return f"{MAINDOC}/UBL-{doctype}-2.1.xsd"
+
+class Validator:
+  """
+  validates documents of a UBL doctype against its maindoc XSD and applicable
+  Schematrons, which are built or loaded on first use and retained
+  """
+  def __init__(self, doctype, schematrons=()):
+    self.doctype     = doctype
+    self.xsd         = xsd(doctype)
+    self.schematrons = list(schematrons)
+    self.warm        = False
+
+  def __repr__(self):
+    return f"Validator({self.doctype})"
+
+  def warmup(self):
+    """
+    loads or builds the XSD and compiles the Schematrons ahead of validation
+    """
+    if self.warm:
+      return
+    load_bundle()
+    with as_file(files(resources)) as resource_root:
+      xml_schema.schema(resource_root / self.xsd)
+      for schematron_filename in self.schematrons:
+        schematron.compile_schematron(resource_root / schematron_filename)
+    self.warm = True
+
+  def validate(
+    self, document, budget=None, report=None, jobs=None, session=None,
+    phase=None, xsd_threshold=0
+  ):
+    """
+    validates an `xml.Document`, see `validate`
+    """
+    self.warmup()
+    # running from package, setup files context
+    with as_file(files(resources)) as resource_root:
+      xsd_errors = xml_schema.errors(
+        document.resource, resource_root / self.xsd, report, budget=budget
+      )
+      exhausted = budget is not None and budget.check()
+      if exhausted and report is not None:
+        report.complete = False
+      if exhausted or xsd_errors > xsd_threshold:
+        return False if xsd_errors else None
+      schematrons = [
+        resource_root / schematron_filename
+        for schematron_filename in self.schematrons
+      ]
+      if session is not None and schematrons:
+        result = session.validate(document, report=report, budget=budget)
+        if report is None:
+          result.log()
+        return result.valid and not xsd_errors
+      if report is not None:
+        for schematron_filename in schematrons:
+          report.namespaces.update(
+            schematron.compile_schematron(schematron_filename, phase).namespaces
+          )
+      valid = schematron.validate(
+        document, schematrons, budget=budget, report=report, jobs=jobs,
+        phase=phase
+      )
+      return False if xsd_errors else valid
+
+REGISTRY = None
+
+def registry():
+  """
+  returns a validator for every UBL maindoc XSD, by the namespace and name of
+  its root element. Validators are built on first use, see `Validator`.
+  """
+  global REGISTRY
+  if REGISTRY is None:
+    REGISTRY = {}
+    with as_file(files(resources)) as resource_root:
+      for path in sorted((resource_root / MAINDOC).glob("UBL-*-2.1.xsd")):
+        doctype = path.name[len("UBL-"):-len("-2.1.xsd")]
+        REGISTRY[(NAMESPACE.format(doctype=doctype), doctype)] = Validator(
+          doctype, DOCTYPE_SCHEMATRONS.get(doctype, [])
+        )
+  return REGISTRY
+
+def validator(xml_root=None, doctype=None) -> Validator:
+  """
+  returns the validator for a doctype, or if omitted, for the root element of a
+  document
+  """
+  if doctype is not None:
+    key = (NAMESPACE.format(doctype=doctype), doctype)
+  else:
+    namespace, _, name = xml_root.tag.rpartition("}")
+    key = (namespace[1:] or None, name)
+  if key not in registry():
+    raise ValueError(f"unknown UBL doctype '{doctype or xml_root.tag}'")
+  return registry()[key]
+
+def validate(
+  src, doctype=None, mode="full", max_errors=None, deadline_ms=None,
+  report=None, jobs=None, session=None, phase=None, xsd_threshold=0
+):
+  """
+  Accepts an `xml.Document`, ElementTree, filepath, bytes or string, returning
+  True if valid, False if not, or None if validation stopped early without
+  finding errors. The document is parsed once, for the XSD and Schematrons.
+  Unless given, the doctype is detected from the root element, see `registry`.
+  modes: "full", or "fail_fast" to stop at the first error. Validation can also
+  be limited to max_errors and a deadline in milliseconds.
+  Failures are logged, or if a `Report` is given, collected in it.
+  Large documents can be validated across a pool of jobs processes.
+  Successive versions of a document can be validated incrementally, given a
+  `Session`, see `session`.
+  A phase limits the Schematron validation to a phase id, or to pattern ids
+  and/or globs of assertion ids, e.g. "PEPPOL-EN16931-R0*".
+  XSD errors are all collected, within the limits of the mode. The Schematrons
+  are skipped when there are more than xsd_threshold of them.
+  example:
+    % schema-tools ubl validate invoice.xml --mode fail_fast --deadline-ms 50
+    % schema-tools ubl validate invoice.xml --phase codelist_phase
+  """
+  document = xml.document(src)
+  if document.root is None: # not well-formed, which has been logged
+    return False
+
+  # the budget covers the XSD and all Schematrons
+  budget = schematron.make_budget(mode, max_errors, deadline_ms)
+
+  return validator(document.root, doctype).validate(
+    document, budget=budget, report=report, jobs=jobs, session=session,
+    phase=phase, xsd_threshold=xsd_threshold
+  )
+
+def session(phase=None) -> schematron.Session:
+  """
+  returns a `Session` for incremental validation of successive versions of a
+  document against the UBL Schematrons, to pass to `validate`
+  """
+  load_bundle()
+  with as_file(files(resources)) as resource_root:
+    return schematron.Session([
+      resource_root / schematron_filename for schematron_filename in SCHEMATRONS
+    ], phase)
+
+def report(
+  src, doctype=None, mode="full", max_errors=None, deadline_ms=None,
+  jobs=None, phase=None, xsd_threshold=0
+) -> schematron.Report:
+  """
+  validates like `validate`, returning a `Report` of all failures
+  """
+  result = schematron.Report()
+  validate(
+    src, doctype, mode, max_errors, deadline_ms, report=result, jobs=jobs,
+    phase=phase, xsd_threshold=xsd_threshold
+  )
+  return result
+
+def render_report(
+  src, format="rich", doctype=None, mode="full", max_errors=None,
+  deadline_ms=None, jobs=None, phase=None, xsd_threshold=0
+):
+  """
+  validates an XML file, rendering a report of all failures as SVRL, JSON or a rich table
+  example:
+    % schema-tools ubl report invoice.xml --format svrl
+    % schema-tools ubl report invoice.xml --max-errors 50 --xsd-threshold 10
+  """
+  rendered = report(
+    src, doctype, mode, max_errors, deadline_ms, jobs, phase, xsd_threshold
+  ).render(format)
+  if format == "rich":
+    Console().print(rendered)
+  else:
+    print(rendered)
 
-def validate(src, doctype="Invoice"):
+def stream_report(
+  source, doctype=None, mode="full", max_errors=None, deadline_ms=None,
+  phase=None, xsd_threshold=0
+) -> schematron.Report:
   """
-  Accepts and ElementTree or filepath or string
+  validates a huge XML file or stream in roughly constant memory, returning a
+  `Report` of all failures. The XSD is validated on a lazily parsed resource,
+  after which, unless there are more than xsd_threshold XSD errors, the lines
+  are parsed again, one at a time, and validated against the Schematrons, see
+  `streaming`. Streams that can't be rewound are buffered in a temporary file.
   """
-  if isinstance(src, ElementTree.Element):
-    xml_root = src
-  elif Path(src).is_file():
-    xml_root = xml.load(src)
-  elif isinstance(src, str):
-    xml_root = xml.parse(src)
+  if hasattr(source, "read") and not (
+    hasattr(source, "seekable") and source.seekable()
+  ):
+    binary = isinstance(source.read(0), bytes)
+    with tempfile.TemporaryFile("w+b" if binary else "w+") as buffered:
+      shutil.copyfileobj(source, buffered)
+      buffered.seek(0)
+      return stream_report(
+        buffered, doctype, mode, max_errors, deadline_ms, phase, xsd_threshold
+      )
+  result = schematron.Report()
+  budget = schematron.make_budget(mode, max_errors, deadline_ms)
+  resource = xml_schema.lazy_resource(source)
+  if resource is None:
+    result.add(schematron.Failure(
+      "XML", "fatal", "not a well-formed XML document"
+    ))
+    return result
+  found = validator(resource.root, doctype)
+  found.warmup()
+  with as_file(files(resources)) as resource_root:
+    xsd_errors = xml_schema.errors(
+      resource, resource_root / found.xsd, result, budget=budget
+    )
+    if budget is not None and budget.check():
+      result.complete = False
+      return result
+    if xsd_errors > xsd_threshold or not found.schematrons:
+      return result
+    if hasattr(source, "seek"):
+      source.seek(0)
+    return streaming.validate_stream(source, [
+      resource_root / schematron_filename
+      for schematron_filename in found.schematrons
+    ], report=result, budget=budget, phase=phase)
+
+def stream(
+  filename, format="rich", doctype=None, mode="full", max_errors=None,
+  deadline_ms=None, phase=None, xsd_threshold=0
+):
+  """
+  validates a huge XML file against the XSD and Schematrons in roughly constant memory, line by line, rendering a report of all failures as SVRL, JSON or a rich table. Schematron assertions spanning lines are skipped.
+  example:
+    % schema-tools ubl stream consolidated.xml --format json
+  """
+  result   = stream_report(
+    filename, doctype, mode, max_errors, deadline_ms, phase, xsd_threshold
+  )
+  rendered = result.render(format)
+  if format == "rich":
+    Console().print(rendered)
   else:
-    raise ValueError(f"unsupported XML src type: {type(src)}")
+    print(rendered)
+
+# batch validation, across a pool of processes
+
+def warm(doctype=None):
+  """
+  loads or builds the XSD and compiles the Schematrons ahead of validation, of
+  a doctype, or if omitted, the doctypes in a bundle
+  """
+  for name in [ doctype ] if doctype else BUNDLE_DOCTYPES:
+    validator(doctype=name).warmup()
+
+def check(filename, doctype=None):
+  """
+  validates an XML file, of a given or detected doctype, returning a summary
+  with error and warning counts and timings in milliseconds, and the error if
+  the file can't be read
+  """
+  result = {
+    "file"       : str(filename),
+    "doctype"    : doctype,
+    "valid"      : False,
+    "xml_errors" : 0,
+    "xsd_errors" : 0,
+    "errors"     : 0,
+    "warnings"   : 0,
+    "error"      : None,
+    "timings"    : {}
+  }
+  def elapsed(since):
+    return round((time.perf_counter() - since) * 1000, 3)
+
+  start    = time.perf_counter()
+  xml_root = None
+  try:
+    if not Path(filename).is_file(): # e.g. a directory or a pipe
+      raise OSError(f"not a regular file: '{filename}'")
+    document = xml.document(filename)
+    xml_root = document.root
+  except OSError as ex:
+    logger.error(f"[red][XML] {ex}[/red]", extra={"markup": True})
+    result["error"] = str(ex)
+  result["timings"]["xml"] = elapsed(start)
+  if xml_root is None:
+    result["xml_errors"] = 1
+    result["timings"]["total"] = elapsed(start)
+    return result
+  try:
+    found = validator(xml_root, doctype)
+  except ValueError as ex:
+    logger.error(f"[red][XSD] {ex}[/red]", extra={"markup": True})
+    result["xsd_errors"] = 1
+    result["timings"]["total"] = elapsed(start)
+    return result
+  result["doctype"] = found.doctype
+  found.warmup()
+  with as_file(files(resources)) as resource_root:
+    since = time.perf_counter()
+    valid = xml_schema.validate(document.resource, resource_root / found.xsd)
+    result["timings"]["xsd"] = elapsed(since)
+    if not valid:
+      result["xsd_errors"] = 1
+    else:
+      since = time.perf_counter()
+      for schematron_filename in found.schematrons:
+        errors, warnings = schematron.compile_schematron(
+          resource_root / schematron_filename
+        ).evaluate(document)
+        result["errors"]   += errors
+        result["warnings"] += warnings
+      result["timings"]["schematron"] = elapsed(since)
+      result["valid"] = not result["errors"]
+  result["timings"]["total"] = elapsed(start)
+  return result
+
+def _init_worker(doctype, quiet):
+  if quiet:
+    logging.getLogger("schema_tools").setLevel(logging.CRITICAL)
+  warm(doctype)
+
+def _check(args):
+  return check(*args)
+
+def iter_check(filenames, jobs=None, doctype=None, quiet=True):
+  """
+  validates XML files across a pool of processes, each warming its caches
+  once, yielding a summary per file, in the order of the files. Logging of the
+  worker processes is silenced, unless quiet is False.
+  """
+  filenames = [ (filename, doctype) for filename in filenames ]
+  jobs      = jobs or os.cpu_count() or 1
+  if jobs == 1:
+    warm(doctype)
+    yield from map(_check, filenames)
+    return
+  chunksize = max(1, min(16, len(filenames) // (jobs * 4)))
+  with multiprocessing.Pool(
+    jobs, initializer=_init_worker, initargs=(doctype, quiet)
+  ) as pool:
+    yield from pool.imap(_check, filenames, chunksize=chunksize)
+
+def expand(pattern):
+  """
+  returns the XML files in a directory or matching a glob pattern
+  """
+  if Path(pattern).is_dir():
+    return sorted(str(path) for path in Path(pattern).rglob("*.xml"))
+  return sorted(glob.glob(pattern, recursive=True))
 
-  # running from package, setup files context
+def validate_many(pattern, jobs=None, doctype=None):
+  """
+  validates all XML files in a directory or matching a glob pattern across a pool of processes, printing one JSON line per file
+  example:
+    % schema-tools ubl validate-many "invoices/**/*.xml" --jobs 8
+  """
+  start   = time.perf_counter()
+  files   = expand(pattern)
+  invalid = 0
+  for result in iter_check(files, jobs=jobs, doctype=doctype):
+    invalid += not result["valid"]
+    print(json.dumps(result), file=sys.stdout, flush=True)
+  logger.info(
+    f"validated {len(files)} files, {invalid} invalid, "
+    f"in {time.perf_counter() - start:.3f}s"
+  )
+
+# validation bundle, holding built XSDs and compiled Schematrons
+
+def cache_dir():
+  """
+  returns the directory holding validation bundles, which can be set using the
+  SCHEMA_TOOLS_CACHE environment variable
+  """
+  return Path(os.environ.get("SCHEMA_TOOLS_CACHE") or (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "schema-tools"
+  ))
+
+def resources_hash():
+  """
+  computes a hash of the content of the resources and the versions of the
+  libraries that are pickled in a bundle
+  """
+  hash = hashlib.sha256()
+  for version in [
+    str(BUNDLE_FORMAT), __version__, xmlschema.__version__, elementpath.__version__
+  ]:
+    hash.update(version.encode())
+  with as_file(files(resources)) as resource_root:
+    for path in sorted(resource_root.rglob("*")):
+      if path.is_file() and path.suffix in [ ".xsd", ".sch" ]:
+        hash.update(str(path.relative_to(resource_root)).encode())
+        hash.update(path.read_bytes())
+  return hash.hexdigest()
+
+def bundle_path(directory=None, digest=None):
+  """
+  returns the path of the validation bundle for the current resources
+  """
+  digest = digest or resources_hash()
+  return Path(directory or cache_dir()) / f"ubl-{digest[:16]}.bundle"
+
+def build_bundle(directory=None, doctypes=BUNDLE_DOCTYPES):
+  """
+  builds the XSDs and compiles the Schematrons, writing them to a versioned validation bundle, which is loaded by subsequent processes
+  example:
+    % schema-tools ubl build-bundle
+  """
+  digest = resources_hash()
+  path   = bundle_path(directory, digest)
+  with as_file(files(resources)) as resource_root:
+    bundle = {
+      "format"      : BUNDLE_FORMAT,
+      "hash"        : digest,
+      "xsds"        : {
+        xsd(doctype) : xml_schema.schema(resource_root / xsd(doctype))
+        for doctype in doctypes
+      },
+      "schematrons" : {
+        schematron_filename : schematron.compile_schematron(
+          resource_root / schematron_filename
+        )
+        for schematron_filename in SCHEMATRONS
+      }
+    }
+  path.parent.mkdir(parents=True, exist_ok=True)
+  temp = path.with_suffix(f".{os.getpid()}.tmp")
+  with temp.open("wb") as fp:
+    pickle.dump(bundle, fp, protocol=pickle.HIGHEST_PROTOCOL)
+  temp.replace(path)
+  logger.info(f"wrote validation bundle to '{path}'")
+  return str(path)
+
+BUNDLE_LOADED = None
+
+def load_bundle(directory=None):
+  """
+  loads a validation bundle, if available, into the XSD and Schematron caches,
+  once per process. The bundle is unpickled, so its directory must be trusted.
+  """
+  global BUNDLE_LOADED
+  if BUNDLE_LOADED is not None:
+    return BUNDLE_LOADED
+  BUNDLE_LOADED = False
+  digest = resources_hash()
+  path   = bundle_path(directory, digest)
+  if not path.is_file():
+    return BUNDLE_LOADED
+  try:
+    with path.open("rb") as fp:
+      bundle = pickle.load(fp)
+  except (
+    OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError
+  ) as ex: # e.g. truncated, or pickled with other versions of the classes
+    logger.warning(f"can't load validation bundle '{path}': {ex}")
+    return BUNDLE_LOADED
+  if bundle.get("format") != BUNDLE_FORMAT or bundle.get("hash") != digest:
+    logger.warning(f"ignoring outdated validation bundle '{path}'")
+    return BUNDLE_LOADED
   with as_file(files(resources)) as resource_root:
-    if xml_schema.validate(
-      xml_root,
-      resource_root / f"UBL-2/xsd/maindoc/UBL-{doctype}-2.1.xsd"
-    ):
-      schematron.validate(xml_root, [
-        resource_root / "CEN-EN16931-UBL.sch",
-        resource_root / "PEPPOL-EN16931-UBL.sch"
-      ])
+    for name, schema in bundle["xsds"].items():
+      xml_schema.SCHEMAS[str((resource_root / name).resolve())] = schema
+    for name, compiled in bundle["schematrons"].items():
+      compiler.SCHEMATRONS[str((resource_root / name).resolve())] = compiled
+  logger.debug(f"loaded validation bundle '{path}'")
+  BUNDLE_LOADED = True
+  return BUNDLE_LOADED
 
 # expose cli-enabled functions
 cli = {
-  "validate" : validate
+  "validate"      : validate,
+  "report"        : render_report,
+  "stream"        : stream,
+  "validate_many" : validate_many,
+  "build_bundle"  : build_bundle
 }
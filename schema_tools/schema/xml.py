@@ -1,22 +1,87 @@
+from pathlib import Path
+
 import xmlschema
 import logging
 
+from schema_tools.schema.schematron.reporting import Failure
+
 logger = logging.getLogger(__name__)
 
-def validate(xml_root, xsd_filename):
+SCHEMAS = {}
+
+def schema(xsd_filename) -> xmlschema.XMLSchema:
+  """
+  returns the built schema for an XSD file, which is built once per process and
+  reused for subsequent validations
+  """
+  key = str(Path(xsd_filename).resolve())
+  if key not in SCHEMAS:
+    logger.debug(f"building XSD '{key}'")
+    SCHEMAS[key] = xmlschema.XMLSchema(key)
+  return SCHEMAS[key]
+
+def lazy_resource(source):
+  """
+  returns an xmlschema resource on an XML file or stream, that is parsed lazily
+  while it is validated, in roughly constant memory, instead of building the
+  whole ElementTree, or None if it can't be parsed
+  """
+  try:
+    return xmlschema.XMLResource(source, lazy=True)
+  except xmlschema.exceptions.XMLResourceParseError as ex:
+    logger.error(f"[red][XML] {ex}[/red]", extra={"markup": True})
+  return None
+
+def iter_errors(xml_root, xsd_filename, budget=None):
+  """
+  yields the XSD validation errors of an ElementTree or xmlschema resource,
+  lazily, so that callers can stop validating at any time. Elements are skipped
+  once a `Budget` is exhausted, also when no errors are found.
+  """
+  hook = None
+  if budget is not None:
+    def hook(element, xsd_element):
+      return budget.check() # skips the element and its content
+  try:
+    yield from schema(xsd_filename).iter_errors(xml_root, validation_hook=hook)
+  except xmlschema.exceptions.XMLResourceParseError as ex:
+    yield ex
+
+def errors(xml_root, xsd_filename, report=None, max_errors=None, budget=None):
+  """
+  validates an ElementTree or xmlschema resource against an XSD, logging the
+  errors, or if a `Report` is given, adding them as failures, returning the
+  number of errors. Validation stops after max_errors, or when a `Budget` is
+  exhausted.
+  """
   logger.info(
     f"validating against XSD '{xsd_filename.name}'",
     extra={"markup": True}
   )
-  # XSD validation
-  try:
-    xmlschema.validate(xml_root, xsd_filename)
-    return True
-  except xmlschema.validators.exceptions.XMLSchemaValidationError as ex:
-    logger.error(f"[red][XSD][/red] {ex}", extra={"markup": True})
-  except xmlschema.exceptions.XMLResourceParseError as ex:
-    logger.error(f"[red][XSD] {ex}[/red]", extra={"markup": True})
-  except xmlschema.validators.exceptions.XMLSchemaChildrenValidationError as ex:
-    logger.error(f"[red][XSD] {ex.reason}[/red]", extra={"markup": True})
-    logger.debug(str(ex)) # full exception with schema and instance excerpts
-  return False
+  found = 0
+  for error in iter_errors(xml_root, xsd_filename, budget):
+    found += 1
+    if isinstance(error, xmlschema.exceptions.XMLResourceParseError):
+      message, location = str(error), None
+      if report is None:
+        logger.error(f"[red][XSD] {error}[/red]", extra={"markup": True})
+    else:
+      message, location = error.reason or str(error), error.path
+      if report is None:
+        logger.error(f"[red][XSD][/red] {error}", extra={"markup": True})
+    if report is not None:
+      report.add(Failure(
+        "XSD", "fatal", message, location=location,
+        source=Path(xsd_filename).name
+      ))
+    exhausted = budget is not None and budget.spend(1)
+    if exhausted or (max_errors is not None and found >= max_errors):
+      break
+  return found
+
+def validate(xml_root, xsd_filename, report=None, max_errors=1, budget=None):
+  """
+  validates an ElementTree or xmlschema resource against an XSD, logging the
+  first error, or given max_errors, up to that many, see `errors`
+  """
+  return not errors(xml_root, xsd_filename, report, max_errors, budget)
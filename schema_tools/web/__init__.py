@@ -10,7 +10,6 @@ from schema_tools        import xml
 from schema_tools        import peppol
 from schema_tools.schema import ubl
 
-import xmltodict
 from jinja2 import BaseLoader, Undefined
 from jinja2.sandbox import SandboxedEnvironment
 
@@ -94,9 +93,9 @@ def home():
 @return_console
 def validate():
   src      = request.form.get("ubl")
-  doctype  = request.form.get("doctype", "Invoice")
-  xml_root = xml.parse(src)
-  return ubl.validate(xml_root, doctype=doctype)
+  doctype  = request.form.get("doctype") or None # detected, unless given
+  document = xml.Document(src)
+  ubl.validate(document, doctype=doctype) # the outcome is logged to the console
 
 @app.route("/peppol/check", methods=["POST"], endpoint="check")
 @protected
@@ -111,27 +110,21 @@ def view():
   src           = request.form.get("xml").strip()
   meta_template = request.form.get("markdown", "# 4 Ooh 4 Missing Markdown")
 
-  # collect namespaces, to strip later
-  xml  = xmltodict.parse(src)
-  root = list(xml.keys())[0]
-  namespaces = {
-    uri : None for key, uri in xml[root].items() if key.startswith("@xmlns")
-  }
-  logger.debug({"namespaces": namespaces})
-
-  # parse xml again to dict, now omitting namespaces
-  xml = xmltodict.parse(src, process_namespaces=True, namespaces=namespaces)
-  logger.debug(json.dumps(xml,indent=2))
+  # parse xml once to a dict, omitting namespaces
+  document = xml.Document(src)
+  logger.debug({"namespaces": document.namespaces})
+  xml_dict = document.dict
+  logger.debug(json.dumps(xml_dict,indent=2))
 
   # construct template and render html
   template = SandboxedEnvironment(
     loader=BaseLoader(),undefined=SilentUndefined
   ).from_string(meta_template)
   html = markdown(
-    template.render(xml=xml, ensure_list=ensure_list),
+    template.render(xml=xml_dict, ensure_list=ensure_list),
     extensions=["tables", "attr_list"]
   )
   return render_template(
     "render.html",
-    body=html, debug=json.dumps(xml, indent=2)
+    body=html, debug=json.dumps(xml_dict, indent=2)
   )
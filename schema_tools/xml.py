@@ -1,7 +1,11 @@
 from xml.etree import ElementTree
+from xml.parsers import expat
 
 from pathlib import Path
 
+import elementpath
+import xmlschema
+
 from schema_tools.schema import xml as xml_schema
 
 import logging
@@ -19,7 +23,7 @@ def load(xml_filename, xsd_filename=None):
   optionally performs XSD schema validation, loads an XML file, returning a parsed ElementTree
   """
 
-  xml_root = parse(Path(xml_filename).read_text())
+  xml_root, _, _ = load_document(xml_filename)
   if  xml_root is None:
     return None
 
@@ -40,3 +44,200 @@ def namespaces(filename):
     return dict([
       node for _, node in ElementTree.iterparse(fp, events=['start-ns'])
     ])
+
+CHUNK_SIZE = 64 * 1024
+
+def load_document(source, lines=False):
+  """
+  parses an XML file, stream or bytes once, returning its root, the namespaces
+  in use and, optionally, a table of the source line of every element, or a
+  None root if it isn't well-formed
+  """
+  if isinstance(source, (bytes, bytearray)):
+    return _load_document([ source ], lines)
+  if hasattr(source, "read"):
+    return _load_document(_chunks(source), lines)
+  with Path(source).open("rb") as fp:
+    return _load_document(_chunks(fp), lines)
+
+def _chunks(stream):
+  # binary and text streams, which return b"" and "" at their end
+  chunk = stream.read(CHUNK_SIZE)
+  while chunk:
+    yield chunk
+    chunk = stream.read(CHUNK_SIZE)
+
+def _load_document(chunks, lines):
+  if lines:
+    return _load_with_lines(chunks)
+  builder = NamespaceTreeBuilder()
+  parser  = ElementTree.XMLParser(target=builder)
+  try:
+    for chunk in chunks:
+      parser.feed(chunk)
+    xml_root = parser.close()
+  except ElementTree.ParseError as ex:
+    logger.error(f"[red][XML] {ex}", extra={"markup": True})
+    return None, builder.namespaces, None
+  return xml_root, builder.namespaces, None
+
+class NamespaceTreeBuilder(ElementTree.TreeBuilder):
+  """
+  builds an ElementTree, collecting the namespace declarations on the way
+  """
+  def __init__(self):
+    super().__init__()
+    self.namespaces = {}
+
+  def start_ns(self, prefix, uri):
+    self.namespaces[prefix] = uri
+
+def _load_with_lines(chunks):
+  # the C parser of ElementTree doesn't expose positions, expat does
+  builder    = ElementTree.TreeBuilder()
+  parser     = expat.ParserCreate(namespace_separator="}")
+  namespaces = {}
+  table      = {}
+  def name(qname):
+    return "{" + qname if "}" in qname else qname
+  def start(tag, attributes):
+    element = builder.start(
+      name(tag), { name(key) : value for key, value in attributes.items() }
+    )
+    table[element] = parser.CurrentLineNumber
+  def start_ns(prefix, uri):
+    namespaces[prefix or ""] = uri
+  parser.buffer_text                = True
+  parser.StartElementHandler        = start
+  parser.EndElementHandler          = lambda tag: builder.end(name(tag))
+  parser.CharacterDataHandler       = builder.data
+  parser.StartNamespaceDeclHandler  = start_ns
+  try:
+    for chunk in chunks:
+      parser.Parse(chunk, False)
+    parser.Parse(b"", True)
+  except expat.ExpatError as ex:
+    logger.error(f"[red][XML] {ex}", extra={"markup": True})
+    return None, namespaces, None
+  return builder.close(), namespaces, table
+
+class Document:
+  """
+  an XML document, owning its raw bytes, or text, that lazily creates and
+  caches the views consumers need: its ElementTree, namespaces, xmlschema
+  resource, elementpath node trees and a namespace-stripped dict, parsing it
+  only once
+  """
+  def __init__(self, data=None, xml_root=None):
+    self.data        = data
+    self._parsed     = xml_root is not None
+    self._root       = xml_root
+    self._namespaces = {}
+    self._resource   = None
+    self._nodes      = {}
+    self._dict       = None
+
+  def __repr__(self):
+    return f"Document({self.root})"
+
+  def _parse(self):
+    if not self._parsed:
+      if isinstance(self.data, str):
+        # already decoded text, any encoding declaration no longer applies
+        self._root, self._namespaces, _ = _load_document([ self.data ], False)
+      else:
+        self._root, self._namespaces, _ = load_document(self.data)
+      self._parsed = True
+
+  @property
+  def root(self):
+    """
+    the ElementTree root, or None if the document isn't well-formed
+    """
+    self._parse()
+    return self._root
+
+  @property
+  def namespaces(self):
+    """
+    the namespaces declared in the document, by their prefix
+    """
+    self._parse()
+    return self._namespaces
+
+  @property
+  def resource(self) -> xmlschema.XMLResource:
+    """
+    an xmlschema resource on the ElementTree, for XSD validation
+    """
+    if self._resource is None:
+      self._resource = xmlschema.XMLResource(self.root)
+    return self._resource
+
+  def node(self, namespaces=None):
+    """
+    returns the elementpath node tree of the root element, with a document
+    node as its parent, for given namespaces
+    """
+    key = tuple(sorted((namespaces or {}).items()))
+    if key not in self._nodes:
+      self._nodes[key] = elementpath.get_node_tree(
+        ElementTree.ElementTree(self.root), namespaces
+      ).getroot()
+    return self._nodes[key]
+
+  @property
+  def dict(self):
+    """
+    the document as a dict, without namespace prefixes, in the layout of
+    `xmltodict`
+    """
+    if self._dict is None:
+      if self.root is None:
+        raise ValueError("not a well-formed XML document")
+      attributes = { "@xmlns" : dict(self.namespaces) } if self.namespaces else {}
+      self._dict = {
+        _local(self.root.tag) : _as_dict(self.root, attributes)
+      }
+    return self._dict
+
+def _local(name):
+  return name.split("}")[-1]
+
+def _as_dict(element, attributes=None):
+  result = dict(attributes or {})
+  result.update(
+    (f"@{_local(name)}", value) for name, value in element.attrib.items()
+  )
+  children = {}
+  for child in element:
+    children.setdefault(_local(child.tag), []).append(_as_dict(child))
+  text = "".join(
+    [ element.text or "" ] + [ child.tail or "" for child in element ]
+  ).strip()
+  if not result and not children:
+    return text or None
+  result.update(
+    (name, values[0] if len(values) == 1 else values)
+    for name, values in children.items()
+  )
+  if text:
+    result["#text"] = text
+  return result
+
+def document(src) -> Document:
+  """
+  returns a `Document` for an existing one, an ElementTree, bytes, an XML
+  string or a filename
+  """
+  if isinstance(src, Document):
+    return src
+  if isinstance(src, ElementTree.Element):
+    return Document(xml_root=src)
+  if isinstance(src, (bytes, bytearray)):
+    return Document(src)
+  if isinstance(src, str) and src.lstrip().startswith("<"):
+    return Document(src)
+  if Path(src).is_file():
+    return Document(Path(src).read_bytes())
+  raise ValueError(f"unsupported XML src type: {type(src)}")
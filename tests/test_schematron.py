@@ -0,0 +1,465 @@
+import copy
+import json
+import pickle
+from pathlib import Path
+from xml.etree import ElementTree
+
+from schema_tools import xml
+from schema_tools.schema import schematron
+
+EXAMPLES  = Path(__file__).parent / "examples"
+RESOURCES = Path(__file__).parent.parent / "schema_tools" / "resources"
+
+CEN    = RESOURCES / "CEN-EN16931-UBL.sch"
+PEPPOL = RESOURCES / "PEPPOL-EN16931-UBL.sch"
+
+def test_compiled_schematron_is_reused():
+  assert schematron.compile_schematron(CEN) is schematron.compile_schematron(CEN)
+
+def test_compiled_schematron_contains_compiled_expressions():
+  compiled = schematron.compile_schematron(PEPPOL)
+  assert compiled.namespaces["cbc"] == "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+  assert len(compiled.patterns) == 13
+  rule = compiled.patterns[0].rules[0]
+  assert isinstance(rule.context, schematron.Expression)
+  assert rule.context.token is not None
+  assert rule.assertions[0].id == "PEPPOL-EN16931-R008"
+
+def test_compiled_schematron_validation():
+  good = xml.load(EXAMPLES / "invoice.xml")
+  bad  = xml.load(EXAMPLES / "invoice.bad-schema.xml")
+  compiled = schematron.compile_schematron(CEN)
+  assert compiled.validate(good) == 0
+  assert compiled.validate(bad)  == 1
+
+def test_xpath_document_is_reused_for_selects():
+  xml_root   = xml.load(EXAMPLES / "invoice.xml")
+  namespaces = xml.namespaces(EXAMPLES / "invoice.xml")
+  document   = schematron.XPathDocument(xml_root, namespaces)
+  lines = schematron.select_find(document, "cac:InvoiceLine", namespaces=namespaces)
+  assert len(lines) == 2
+  assert schematron.select_query(
+    document, "cbc:ID", namespaces=namespaces, context=lines[1]
+  ) == "2"
+  assert schematron.select_find(xml_root, "cac:InvoiceLine", namespaces=namespaces) == lines
+
+def test_schema_variables_on_xpath_document():
+  schematron_root = xml.load(PEPPOL)
+  namespaces      = schematron.schema_namespaces(schematron_root)
+  document  = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"), namespaces)
+  variables = schematron.schema_variables(document, schematron_root, namespaces)
+  assert [ code.text for code in variables["documentCurrencyCode"] ] == ["EUR"]
+
+def test_rule_contexts_are_matched_as_patterns():
+  compiled  = schematron.compile_schematron(PEPPOL)
+  document  = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"), compiled.namespaces)
+  root      = document.elements[0]
+  rules     = [ rule for pattern in compiled.patterns for rule in pattern.rules ]
+  # relative contexts match the root element, as they would in XSLT
+  relative  = next(
+    rule for rule in rules if rule.context.query == "ubl-creditnote:CreditNote | ubl-invoice:Invoice"
+  )
+  assert relative.matcher is not None
+  assert relative.matches(root, document, {})
+  assert not relative.matches(document.elements[1], document, {})
+
+def test_rule_contexts_can_select_other_nodes_than_elements(tmp_path):
+  cbc   = "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+  rules = tmp_path / "nodes.sch"
+  rules.write_text(f"""<schema xmlns="http://purl.oclc.org/dsdl/schematron">
+  <ns prefix="cbc" uri="{cbc}"/>
+  <pattern>
+    <rule context="//cbc:Amount/@currencyID">
+      <assert id="ATTRIBUTE" test=". = 'USD'" flag="fatal">dollars</assert>
+    </rule>
+    <rule context="/">
+      <assert id="DOCUMENT" test="false()" flag="fatal">document</assert>
+    </rule>
+  </pattern>
+  <pattern>
+    <rule context="cbc:Note/text()">
+      <assert id="TEXT" test="false()" flag="fatal">text</assert>
+    </rule>
+  </pattern>
+</schema>""")
+  document = ElementTree.XML(f"""<Invoice xmlns:cbc="{cbc}">
+  <cbc:Note>note</cbc:Note>
+  <cbc:Amount currencyID="EUR">1</cbc:Amount>
+  <cbc:Amount currencyID="USD">2</cbc:Amount>
+</Invoice>""")
+  report = schematron.Report()
+  schematron.CompiledSchematron(rules).evaluate(document, report=report)
+  assert [ (failure.id, failure.location) for failure in report.failures ] == [
+    ("DOCUMENT",  "/"),
+    ("TEXT",      "/Invoice[1]/cbc:Note[1]/text()"),
+    ("ATTRIBUTE", "/Invoice[1]/cbc:Amount[1]/@currencyID")
+  ]
+
+def test_positional_rule_contexts_are_selected(tmp_path):
+  rules = tmp_path / "positional.sch"
+  rules.write_text("""<schema xmlns="http://purl.oclc.org/dsdl/schematron">
+  <ns prefix="cac" uri="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"/>
+  <pattern>
+    <rule context="//cac:InvoiceLine[position() = 2]">
+      <assert id="SECOND" test="false()" flag="fatal">second</assert>
+    </rule>
+  </pattern>
+  <pattern>
+    <rule context="//cac:InvoiceLine[1]">
+      <assert id="FIRST" test="false()" flag="fatal">first</assert>
+    </rule>
+  </pattern>
+</schema>""")
+  compiled = schematron.CompiledSchematron(rules)
+  assert all(
+    rule.matcher is None for pattern in compiled.patterns for rule in pattern.rules
+  )
+  report = schematron.Report()
+  compiled.evaluate(xml.load(EXAMPLES / "invoice.xml"), report=report)
+  assert [
+    (failure.id, failure.location.split("/")[-1]) for failure in report.failures
+  ] == [ ("FIRST", "cac:InvoiceLine[1]"), ("SECOND", "cac:InvoiceLine[2]") ]
+
+def test_first_matching_rule_of_a_pattern_wins():
+  compiled = schematron.compile_schematron(CEN)
+  document = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"), compiled.namespaces)
+  fired    = {}
+  for node in document.elements:
+    for pattern in compiled.patterns:
+      rule = pattern.match(node, document, {})
+      if rule is not None:
+        fired.setdefault(id(node), []).append(rule)
+  assert fired
+  assert all(len(rules) <= len(compiled.patterns) for rules in fired.values())
+
+def test_xpath_document_indexes_elements_by_name():
+  document = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"))
+  lines    = document.descendants(
+    "{urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2}InvoiceLine"
+  )
+  assert len(lines) == 2
+  assert lines[0].position < lines[1].position
+  assert document.descendants("{urn:unknown}Unknown") == []
+
+def test_rules_are_dispatched_by_element_name():
+  compiled = schematron.compile_schematron(CEN)
+  pattern  = compiled.patterns[0]
+  name     = "{urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2}PaymentMeans"
+  candidates = pattern.candidates(name)
+  assert candidates
+  assert all(rule.names is None or name in rule.names for rule in candidates)
+  assert len(candidates) < len(pattern.rules)
+
+def test_rules_that_cannot_fire_are_skipped():
+  compiled = schematron.compile_schematron(CEN)
+  document = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"), compiled.namespaces)
+  rules      = [ rule for pattern in compiled.patterns for rule in pattern.rules ]
+  applicable = compiled.applicable_rules(document)
+  assert 0 < len(applicable) < len(rules)
+  card = next(
+    rule for rule in rules if rule.context.query == "//cac:PaymentMeans/cac:CardAccount/cbc:PrimaryAccountNumberID"
+  )
+  assert card not in applicable
+
+def test_code_list_idiom_is_rewritten():
+  expression = schematron.Expression(
+    "contains(' EUR USD ', concat(' ', normalize-space(.), ' '))"
+  )
+  assert expression.source == "code-list-contains(' EUR USD ', normalize-space(.))"
+  assert expression.query.startswith("contains(")
+
+def test_code_list_membership_matches_substring_test():
+  document = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"))
+  for value in [ "EUR", "USD", "EU", "", "EUR USD", "XXX" ]:
+    for codes in [ " EUR USD ", "EUR USD", " EUR  USD " ]:
+      query = f"contains('{codes}', concat(' ', '{value}', ' '))"
+      assert "code-list-contains" in schematron.Expression(query).source
+      assert schematron.select(document, query) == (f" {value} " in codes), query
+
+def test_profiler_records_timings(tmp_path):
+  profiler = schematron.Profiler()
+  compiled = schematron.compile_schematron(PEPPOL)
+  compiled.evaluate(xml.load(EXAMPLES / "invoice.xml"), profiler=profiler)
+  kinds = { record["kind"] for record in profiler.report() }
+  assert kinds == { "pattern", "context", "let", "assert" }
+  top = profiler.top(3, kind="assert")
+  assert len(top) == 3
+  assert top[0]["total_ms"] >= top[1]["total_ms"] >= top[2]["total_ms"]
+  profiler.save(tmp_path / "profile.json")
+  assert (tmp_path / "profile.json").read_text().startswith("{")
+
+def test_let_variables_are_evaluated_lazily():
+  compiled = schematron.compile_schematron(PEPPOL)
+  document = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"), compiled.namespaces)
+  scope    = schematron.Scope(document, compiled.variables)
+  assert scope.values == {}
+  assert [ code.text for code in scope["documentCurrencyCode"] ] == ["EUR"]
+  assert list(scope.values) == ["documentCurrencyCode"]
+  assert scope["documentCurrencyCode"] is scope.values["documentCurrencyCode"]
+
+def test_context_dependent_rule_variables_are_evaluated_per_node():
+  compiled = schematron.compile_schematron(PEPPOL)
+  rule = next(
+    rule for pattern in compiled.patterns for rule in pattern.rules
+    if "lineExtensionAmount" in dict(rule.variables)
+  )
+  assert "lineExtensionAmount" in dict(rule.context_variables)
+  document = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"), compiled.namespaces)
+  lines    = schematron.select_find(document, "//cac:InvoiceLine", namespaces=compiled.namespaces)
+  amounts  = [
+    schematron.Scope(document, rule.variables, context=line)["lineExtensionAmount"]
+    for line in lines
+  ]
+  assert amounts[0] != amounts[1]
+
+def test_slack_compares_all_arguments():
+  document = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"))
+  assert schematron.select(document, "slack(1.0, 1.01, 0.02)") is True
+  assert schematron.select(document, "slack(1.0, 2, 0.02)") is False
+
+def test_slack_atomizes_nodes_and_rejects_non_numbers():
+  document = schematron.XPathDocument(
+    ElementTree.XML("<a><amount>10.00</amount><text>ten</text></a>"), {}
+  )
+  def slack(arguments):
+    return schematron.select(document, f"slack({arguments})", namespaces={})
+  assert slack("/a/amount, 10.01, 0.02") is True
+  assert slack("/a/amount, 11, 0.02") is False
+  assert slack("/a/text, 10, 0.02") is False
+  assert slack("/a/missing, 10, 0.02") is False
+  assert slack("number('NaN'), 10, 0.02") is False
+
+def test_shared_subexpressions_are_cached_per_document():
+  compiled = schematron.compile_schematron(CEN)
+  assert "decimal(cbc:Amount)" in compiled.shared
+  document = schematron.XPathDocument(xml.load(EXAMPLES / "invoice.xml"), compiled.namespaces)
+  assert compiled.evaluate(document) == (0, 0)
+  assert document.shared
+  restored = pickle.loads(pickle.dumps(compiled))
+  assert restored.shared == compiled.shared
+  bad = xml.load(EXAMPLES / "invoice.bad-schema.xml")
+  assert restored.evaluate(bad) == compiled.evaluate(bad)
+
+def test_context_free_assertions_are_evaluated_once():
+  compiled   = schematron.compile_schematron(CEN)
+  assertions = [
+    assertion
+    for pattern in compiled.patterns
+    for rule in pattern.rules
+    for assertion in rule.assertions
+  ]
+  context_free = { assertion.id for assertion in assertions if assertion.context_free }
+  assert "BR-CO-05" in context_free
+  assert "BR-52" not in context_free # normalize-space(cbc:ID) != ''
+  profiler = schematron.Profiler()
+  compiled.evaluate(xml.load(EXAMPLES / "invoice.xml"), profiler=profiler)
+  calls = { record["name"] : record["calls"] for record in profiler.report("assert") }
+  assert all(calls[id] == 1 for id in context_free if id in calls)
+
+def test_transpiled_schematron_matches_compiled(tmp_path):
+  module = tmp_path / "rules_cen.py"
+  assert schematron.transpile(CEN, output=module) == str(module)
+  transpiled = schematron.transpiler.load(module)
+  functions  = [
+    assertion.function
+    for pattern in transpiled.patterns
+    for rule in pattern.rules
+    for assertion in rule.assertions
+    if assertion.function is not None
+  ]
+  assert functions
+  compiled = schematron.compile_schematron(CEN)
+  for example in [ "invoice.xml", "invoice.bad-schema.xml" ]:
+    document = xml.load(EXAMPLES / example)
+    assert transpiled.evaluate(document) == compiled.evaluate(document)
+
+def test_simple_assertion_tests_are_translated():
+  namespaces = { "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2" }
+  assert schematron.transpiler.translate("exists(cbc:ID)", namespaces) == \
+         "bool(element.findall('cbc:ID', NAMESPACES))"
+  assert schematron.transpiler.translate("string-length(cbc:ID) > 1", namespaces) is None
+
+def test_translated_assertion_tests_match_interpreted_ones():
+  namespaces = { "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2" }
+  documents  = [
+    '<x xmlns:cbc="{cbc}" a=""><cbc:Note/></x>',
+    '<x xmlns:cbc="{cbc}" a="1"><cbc:Note>note</cbc:Note><cbc:Note/></x>',
+    '<x xmlns:cbc="{cbc}"/>'
+  ]
+  tests = [
+    "cbc:Note", "@a", "(cbc:Note)", "not(cbc:Note)", "not(@a)", "exists(cbc:Note)",
+    "cbc:Note and @a", "cbc:Note = ''", "@a = ''", "count(cbc:Note) = 1"
+  ]
+  for test in tests:
+    translated = schematron.transpiler.translate(test, namespaces)
+    if test in [ "cbc:Note", "@a", "(cbc:Note)" ]:
+      assert translated is None
+      continue
+    function = eval(
+      f"lambda element: {translated}", {
+        "NAMESPACES" : namespaces,
+        "attributes" : schematron.transpiler.attributes,
+        "text"       : schematron.transpiler.text
+      }
+    )
+    for source in documents:
+      element  = ElementTree.XML(source.format(**namespaces))
+      document = schematron.XPathDocument(element, namespaces)
+      expected = bool(schematron.select_query(
+        document, test, namespaces=namespaces, context=document.root
+      ))
+      assert function(element) == expected, (test, source)
+
+def test_validation_stops_when_budget_is_exhausted():
+  compiled = schematron.compile_schematron(CEN)
+  bad      = xml.load(EXAMPLES / "invoice.bad-schema.xml")
+  budget   = schematron.make_budget("fail_fast")
+  assert compiled.evaluate(bad, budget=budget)[0] == 1
+  assert budget.exhausted == "max_errors"
+  budget = schematron.Budget(deadline_ms=0)
+  assert compiled.evaluate(bad, budget=budget) == (0, 0)
+  assert budget.exhausted == "deadline"
+  good = xml.load(EXAMPLES / "invoice.xml")
+  assert schematron.validate(good, [ CEN ], deadline_ms=0) is None
+  assert schematron.validate(good, [ CEN ]) is True
+  assert schematron.validate(bad, [ CEN, PEPPOL ], mode="fail_fast") is False
+
+def test_failures_are_collected_in_a_report():
+  bad    = xml.load(EXAMPLES / "invoice.bad-schema.xml")
+  report = schematron.report(bad, [ CEN ])
+  assert (report.errors, report.warnings) == (1, 1)
+  assert report.valid is False and report.complete
+  failure = next(failure for failure in report.failures if failure.fatal)
+  assert failure.location.startswith("/ubl:Invoice[1]")
+  assert failure.source == "CEN-EN16931-UBL.sch"
+  assert json.loads(report.json())["errors"] == 1
+  svrl = ElementTree.fromstring(report.svrl())
+  asserts = svrl.findall("svrl:failed-assert", { "svrl": schematron.reporting.SVRL })
+  assert [ element.get("id") for element in asserts ] == [ f.id for f in report.failures ]
+
+def test_parallel_evaluation_matches_sequential(monkeypatch):
+  monkeypatch.setattr(schematron.compiler, "MIN_SHARD_SIZE", 5)
+  compiled = schematron.compile_schematron(PEPPOL)
+  document = xml.load(EXAMPLES / "invoice.bad-schema.xml")
+  assert len(compiled._shards(list(range(40)), 2)) > 1
+  # the assertions on the root are spread across the jobs
+  assert compiled._shards(list(range(40)), 2, 9)[:3] == [
+    (0, 1, (0, 4)), (0, 1, (4, 9)), (1, 6, None)
+  ]
+  sequential, parallel = schematron.Report(), schematron.Report()
+  assert compiled.evaluate(document, report=sequential) == \
+         compiled.evaluate(document, report=parallel, jobs=2)
+  assert [ f.as_dict() for f in parallel.failures ] == \
+         [ f.as_dict() for f in sequential.failures ]
+
+def test_document_subexpressions_are_found():
+  expression = schematron.Expression(
+    "//cac:Party[cbc:ID = 'SE'] and cbc:ID = 'S'",
+    namespaces=schematron.compile_schematron(CEN).namespaces
+  )
+  found = schematron.analysis.document_subexpressions(expression.token)
+  assert [ token.source for token in found ] == [ "//cac:Party[cbc:ID = 'SE']" ]
+
+def test_streaming_validation_matches_full_validation():
+  from schema_tools.schema.schematron import streaming
+  example  = EXAMPLES / "invoice.bad-schema.xml"
+  streamed = streaming.validate_stream(example, [ CEN, PEPPOL ])
+  full     = schematron.report(xml.load(example), [ CEN, PEPPOL ])
+  assert "BR-16" in streamed.skipped # at least one line, spans all lines
+  def failures(report):
+    return sorted(
+      (failure.id, failure.location) for failure in report.failures
+      if failure.id not in streamed.skipped
+    )
+  assert failures(streamed) == failures(full)
+  assert (streamed.errors, streamed.warnings) == (full.errors, full.warnings)
+
+def test_assertions_spanning_lines_through_other_variables(tmp_path, monkeypatch):
+  from schema_tools.schema.schematron import streaming
+  monkeypatch.setattr(
+    schematron.compiler, "SCHEMATRONS", dict(schematron.compiler.SCHEMATRONS)
+  )
+  rules = tmp_path / "chained.sch"
+  rules.write_text(f"""<schema xmlns="http://purl.oclc.org/dsdl/schematron">
+  <ns prefix="cac" uri="{streaming.CAC}"/>
+  <ns prefix="ubl" uri="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"/>
+  <let name="lines" value="/ubl:Invoice/cac:InvoiceLine"/>
+  <let name="count" value="count($lines)"/>
+  <pattern>
+    <let name="enough" value="$count &gt; 0"/>
+    <rule context="/ubl:Invoice">
+      <let name="many" value="$enough and $count &gt; 1"/>
+      <assert id="SCHEMA" test="$count = 2" flag="fatal">two lines</assert>
+      <assert id="PATTERN" test="$enough" flag="fatal">lines</assert>
+      <assert id="RULE" test="$many" flag="fatal">more lines</assert>
+      <assert id="HEADER" test="count(*) &gt; 0" flag="fatal">header</assert>
+    </rule>
+  </pattern>
+</schema>""")
+  compiled = schematron.CompiledSchematron(rules)
+  spanning = compiled.spanning(streaming.LINES)
+  assert [ assertion.id for assertion in spanning ] == [ "SCHEMA", "PATTERN", "RULE" ]
+  streamed = streaming.validate_stream(EXAMPLES / "invoice.xml", [ rules ])
+  assert streamed.valid is None and streamed.skipped == [ "SCHEMA", "PATTERN", "RULE" ]
+
+def test_assertions_spanning_lines_through_their_descendants(tmp_path, monkeypatch):
+  from schema_tools.schema.schematron import streaming
+  monkeypatch.setattr(
+    schematron.compiler, "SCHEMATRONS", dict(schematron.compiler.SCHEMATRONS)
+  )
+  rules = tmp_path / "descendants.sch"
+  rules.write_text(f"""<schema xmlns="http://purl.oclc.org/dsdl/schematron">
+  <ns prefix="cac" uri="{streaming.CAC}"/>
+  <ns prefix="ubl" uri="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"/>
+  <pattern>
+    <rule context="/ubl:Invoice">
+      <assert id="TAX" test="not(//cac:ClassifiedTaxCategory)" flag="fatal">no tax</assert>
+      <assert id="PRICE" test="not(descendant::cac:Price)" flag="fatal">no price</assert>
+      <assert id="HEADER" test="//cac:AccountingSupplierParty" flag="fatal">seller</assert>
+    </rule>
+  </pattern>
+</schema>""")
+  streamed = streaming.validate_stream(EXAMPLES / "invoice.xml", [ rules ])
+  assert not streamed.failures and streamed.skipped == [ "TAX", "PRICE" ]
+
+def test_session_reuses_results_of_unchanged_subtrees():
+  from schema_tools.schema.schematron import session as incremental
+  document = xml.load(EXAMPLES / "invoice.xml")
+  session  = schematron.Session([ CEN, PEPPOL ])
+  assert session.validate(document).valid
+  edited = copy.deepcopy(document)
+  quantity = edited.find(
+    "cac:InvoiceLine/cbc:InvoicedQuantity", schematron.compile_schematron(CEN).namespaces
+  )
+  quantity.set("unitCode", "NOT-A-CODE")
+  results = incremental.Results(incremental.fingerprints(edited), session.results)
+  for compiled in session.schematrons:
+    compiled.evaluate(edited, report=schematron.Report(), results=results)
+  assert results.hits and results.misses
+  def failures(report):
+    return [ (failure.id, failure.location) for failure in report.failures ]
+  revalidated = failures(session.validate(edited))
+  assert revalidated and \
+         revalidated == failures(schematron.report(edited, [ CEN, PEPPOL ]))
+
+def test_phases_select_patterns_and_assertions(monkeypatch):
+  monkeypatch.setattr(
+    schematron.compiler, "SCHEMATRONS", dict(schematron.compiler.SCHEMATRONS)
+  )
+  coded = schematron.compile_schematron(CEN, "codelist_phase")
+  assert [ pattern.id for pattern in coded.patterns ] == [ "Codesmodel" ]
+  assert coded is schematron.compile_schematron(CEN, "codelist_phase")
+  selected = schematron.compile_schematron(PEPPOL, "PEPPOL-EN16931-R05*")
+  ids = {
+    assertion.id
+    for pattern in selected.patterns
+    for rule in pattern.rules
+    for assertion in rule.assertions
+  }
+  assert ids and all(id.startswith("PEPPOL-EN16931-R05") for id in ids)
+  document = xml.load(EXAMPLES / "invoice.bad-schema.xml")
+  everything = schematron.report(document, [ PEPPOL ])
+  failures   = schematron.report(document, [ PEPPOL ], phase="PEPPOL-EN16931-R05*")
+  assert [ failure.id for failure in failures.failures ] == [
+    failure.id for failure in everything.failures if failure.id in ids
+  ]
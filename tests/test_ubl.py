@@ -0,0 +1,125 @@
+import os
+from pathlib import Path
+from xml.etree import ElementTree
+
+import pytest
+
+from schema_tools import xml
+from schema_tools.schema import ubl
+from schema_tools.schema import xml as xml_schema
+from schema_tools.schema.schematron import compiler
+
+
+def test_validation_bundle_round_trip(tmp_path, monkeypatch):
+  monkeypatch.setattr(ubl, "BUNDLE_LOADED", None)
+  monkeypatch.setattr(xml_schema, "SCHEMAS", dict(xml_schema.SCHEMAS))
+  monkeypatch.setattr(compiler, "SCHEMATRONS", dict(compiler.SCHEMATRONS))
+
+  path = Path(ubl.build_bundle(tmp_path, doctypes=["Invoice"]))
+  assert path.parent == tmp_path
+  assert ubl.resources_hash()[:16] in path.name
+
+  built = dict(xml_schema.SCHEMAS)
+  assert ubl.load_bundle(tmp_path)
+  assert ubl.load_bundle(tmp_path) # only loaded once
+  loaded = [ key for key, schema in xml_schema.SCHEMAS.items() if schema is not built[key] ]
+  assert len(loaded) == 1 and loaded[0].endswith("UBL-Invoice-2.1.xsd")
+  assert len(compiler.SCHEMATRONS) == 2
+
+def test_missing_validation_bundle(tmp_path, monkeypatch):
+  monkeypatch.setattr(ubl, "BUNDLE_LOADED", None)
+  assert not ubl.load_bundle(tmp_path)
+
+def test_corrupt_validation_bundle_is_ignored(tmp_path, monkeypatch):
+  monkeypatch.setattr(ubl, "BUNDLE_LOADED", None)
+  ubl.bundle_path(tmp_path).write_bytes(b"\x80\x05truncated")
+  assert not ubl.load_bundle(tmp_path)
+
+EXAMPLES = Path(__file__).parent / "examples"
+
+def test_batch_validation_reports_per_file():
+  files = ubl.expand(str(EXAMPLES / "invoice*.xml"))
+  assert [ Path(f).name for f in files ] == [
+    "invoice.bad-schema.xml", "invoice.bad.xml", "invoice.xml"
+  ]
+  results = list(ubl.iter_check(files, jobs=1))
+  assert [ result["file"] for result in results ] == files
+  bad_schema, bad, good = results
+  assert good["valid"] and good["errors"] == 0
+  assert bad["xsd_errors"] == 1 and not bad["valid"]
+  assert bad_schema["errors"] == 3 and bad_schema["warnings"] == 1
+  assert set(good["timings"]) == { "xml", "xsd", "schematron", "total" }
+
+def test_batch_validation_reports_unreadable_files(tmp_path):
+  (tmp_path / "folder.xml").mkdir()
+  files   = [ str(tmp_path / "folder.xml"), str(tmp_path / "missing.xml") ]
+  results = list(ubl.iter_check(files + [ str(EXAMPLES / "invoice.xml") ], jobs=1))
+  assert [ result["file"] for result in results[:2] ] == files
+  assert all(
+    result["xml_errors"] == 1 and result["error"] and not result["valid"]
+    for result in results[:2]
+  )
+  assert results[2]["valid"] and results[2]["error"] is None
+
+def test_doctypes_are_detected_from_the_root_element():
+  invoice = xml.load(EXAMPLES / "invoice.xml")
+  assert ubl.validator(invoice) is ubl.validator(doctype="Invoice")
+  assert ubl.validator(invoice).schematrons == ubl.SCHEMATRONS
+  order = ElementTree.XML(
+    '<Order xmlns="urn:oasis:names:specification:ubl:schema:xsd:Order-2"/>'
+  )
+  assert ubl.validator(order).doctype == "Order"
+  assert ubl.validator(order).schematrons == []
+  assert len(ubl.registry()) == 65
+  with pytest.raises(ValueError):
+    ubl.validator(ElementTree.XML("<Invoice/>"))
+  assert ubl.validate(invoice)
+  assert not ubl.validate(order) # the XSD requires an ID, ...
+
+def test_xsd_errors_are_collected_up_to_a_maximum():
+  document = xml.load(EXAMPLES / "invoice.xml")
+  for line in document.findall(f"{{{ubl.streaming.CAC}}}InvoiceLine"):
+    ElementTree.SubElement(line, "trash")
+  def failures(report):
+    return [ failure.id.split("-")[0] for failure in report.failures ]
+  everything = ubl.report(document)
+  assert failures(everything) == [ "XSD", "XSD" ] and everything.complete
+  limited = ubl.report(document, max_errors=1)
+  assert failures(limited) == [ "XSD" ] and not limited.complete
+  assert failures(ubl.report(document, xsd_threshold=2)) == [
+    "XSD", "XSD", "PEPPOL", "PEPPOL"
+  ]
+
+def test_xsd_validation_stops_at_the_deadline():
+  document = xml.load(EXAMPLES / "invoice.xml")
+  for line in document.findall(f"{{{ubl.streaming.CAC}}}InvoiceLine"):
+    ElementTree.SubElement(line, "trash")
+  xsd    = Path(ubl.__file__).parent.parent / "resources" / ubl.xsd("Invoice")
+  budget = ubl.schematron.Budget(deadline_ms=0)
+  assert xml_schema.errors(document, xsd, budget=budget) == 0
+  assert budget.exhausted == "deadline"
+  late = ubl.report(document, deadline_ms=0)
+  assert not late.failures and not late.complete
+
+def test_huge_documents_are_validated_lazily():
+  bad = ubl.stream_report(EXAMPLES / "invoice.bad.xml")
+  assert [ failure.id for failure in bad.failures ] == [ "XSD" ]
+  with (EXAMPLES / "invoice.bad-schema.xml").open("rb") as fp:
+    streamed = ubl.stream_report(fp)
+  full = ubl.report(EXAMPLES / "invoice.bad-schema.xml")
+  def failures(report):
+    return { (failure.id, failure.location) for failure in report.failures }
+  assert failures(streamed) and failures(streamed) <= failures(full)
+
+def test_huge_documents_are_validated_lazily_from_unseekable_streams():
+  read, write = os.pipe()
+  os.write(write, (EXAMPLES / "invoice.bad-schema.xml").read_bytes())
+  os.close(write)
+  with os.fdopen(read, "rb") as fp:
+    assert not fp.seekable()
+    streamed = ubl.stream_report(fp)
+  with (EXAMPLES / "invoice.bad-schema.xml").open("rb") as fp:
+    expected = ubl.stream_report(fp)
+  def failures(report):
+    return [ (failure.id, failure.location) for failure in report.failures ]
+  assert failures(streamed) and failures(streamed) == failures(expected)
@@ -1,7 +1,12 @@
+from xml.etree import ElementTree
+
 from pathlib import Path
 
+import io
+
 from schema_tools        import xml
 from schema_tools.schema import ubl
+from schema_tools.schema import xml as xml_schema
 
 def test_good_validation():
   xml_root = xml.load(Path(__file__).parent / "examples" / "invoice.xml")
@@ -17,3 +22,49 @@ def test_bad_xml_validation():
     assert False, "should throw an XML schema validation exception"
   except Exception:
     pass
+
+def test_xsd_schema_is_built_once():
+  xsd = Path(__file__).parent.parent / "schema_tools" / "resources" / "UBL-2" / "xsd" / "maindoc" / "UBL-Invoice-2.1.xsd"
+  assert xml_schema.schema(xsd) is xml_schema.schema(str(xsd))
+
+def test_document_is_loaded_in_one_pass():
+  example = Path(__file__).parent / "examples" / "invoice.xml"
+  xml_root, namespaces, lines = xml.load_document(example)
+  assert namespaces == xml.namespaces(example)
+  assert lines is None
+  with example.open("rb") as fp:
+    streamed, _, lines = xml.load_document(fp, lines=True)
+  assert ElementTree.tostring(streamed) == ElementTree.tostring(xml_root)
+  assert lines[streamed] == 2
+  assert lines[streamed[1]] == 6 # cbc:ProfileID
+  assert xml.load_document(b"<a><b></a>") == (None, {}, None)
+
+def test_documents_are_loaded_from_text_streams():
+  example = Path(__file__).parent / "examples" / "invoice.xml"
+  with example.open(encoding="utf-8") as fp:
+    xml_root, namespaces, _ = xml.load_document(fp)
+  assert ElementTree.tostring(xml_root) == ElementTree.tostring(xml.load(example))
+  assert namespaces == xml.namespaces(example)
+  _, _, lines = xml.load_document(io.StringIO("<a>\n<b/></a>"), lines=True)
+  assert sorted(lines.values()) == [ 1, 2 ]
+
+def test_document_views_are_created_once(monkeypatch):
+  example  = Path(__file__).parent / "examples" / "invoice.xml"
+  document = xml.document(example)
+  parsed   = []
+  load     = xml.load_document
+  monkeypatch.setattr(xml, "load_document", lambda *args: parsed.append(args) or load(*args))
+  assert ubl.validate(document)
+  assert ubl.validate(document)
+  assert len(parsed) == 1
+  assert document.resource is document.resource
+  assert document.node(document.namespaces) is document.node(document.namespaces)
+  assert document.dict["Invoice"]["ID"] == "Snippet1"
+  assert xml.document(document) is document
+  assert xml.document(document.root).root is document.root
+
+def test_documents_keep_the_text_of_strings_and_bytes():
+  declared = '<?xml version="1.0" encoding="ISO-8859-1"?><a>\u00e9</a>'
+  assert xml.document(declared).root.text == "\u00e9"
+  assert xml.document(declared.encode("iso-8859-1")).root.text == "\u00e9"
+  assert xml.document(declared).dict == { "a" : "\u00e9" }